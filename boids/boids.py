@@ -13,18 +13,29 @@ http://www.kfish.org/boids/pseudocode.html
 """
 
 import sys
+import argparse
 import curses
 import locale
 import time
 import math
 import heapq
+import signal
+import csv
+import contextlib
+import collections as co
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
 
 DEBUG = False
 
 
 BODY_COUNT = 250
+# Headless benchmark sweep, legacy KdTree is too slow for bigger flocks
+BENCHMARK_COUNTS = [250, 1000, 5000, 10000, 50000]
+BENCHMARK_KDTREE_MAX = 5000
 VIEW_ANGLE = math.radians(120)
+VIEW_COS = math.cos(VIEW_ANGLE/2)
 MIN_DIST = 5
 VIEW_RADIUS = 10
 WEIGHT_VEL = 0.1
@@ -32,6 +43,9 @@ WEIGHT_NEIGHB_DIST = 0.15
 WEIGHT_MIN_DIST = 0.15
 MAX_VEL = 8
 
+# Per frame phases, in status overlay and trace file
+PHASES = ['build', 'query', 'fov', 'rules', 'integrate', 'rasterize', 'write']
+
 NUM_AXIS = 2
 Y_AXIS = 0
 X_AXIS = 1
@@ -96,6 +110,245 @@ class Body:
                 self.vel[axis] = -MAX_VEL / 2
 
 
+class PhaseTimer:
+    """Accumulate wall time spent in named phases."""
+
+    def __init__(self):
+        self.totals = co.defaultdict(float)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        tic = time.perf_counter()
+        yield
+        self.totals[name] += time.perf_counter() - tic
+
+    def merge(self, totals):
+        """Add phases of parallel work, longest one counts (as wall time)."""
+        for name in PHASES:
+            self.totals[name] += max([t.get(name, 0) for t in totals], default=0)
+
+
+class Flock:
+    """
+    Structure of arrays version of Body. Positions and velocities of all boids
+    are kept in contiguous (N, 2) arrays, so rules, velocity adjustment and
+    screen wrapping are computed for whole flock at once.
+    """
+
+    def __init__(self, screen_size, count):
+        self.screen_size = screen_size
+        self.pos = np.column_stack([np.random.uniform(0, screen_size[Y_AXIS], size=count),
+                                    np.random.uniform(0, screen_size[X_AXIS], size=count)])
+        self.vel = np.random.uniform(-MAX_VEL/2, MAX_VEL/2, size=[count, NUM_AXIS])
+
+        # Arrays are updated in place, so views stay valid between frames
+        self.bodies = [FlockBody(self, idx) for idx in range(count)]
+
+    def step(self, neighbors, dist_squared, timer=None):
+        """
+        Apply rules and move boids. Neighbors are (N, k) matrix of neighbor
+        indexes padded with -1, dist_squared is matrix of the same shape.
+        """
+        timer = timer or PhaseTimer()
+
+        dv = flock_rules(self.pos, self.vel, self.pos, self.vel, neighbors, dist_squared,
+                         self.screen_size, timer)
+
+        with timer.phase('integrate'):
+            self.vel += dv
+            self.pos += self.vel * DT
+            self.adjust_vel()
+            self.adjust_pos()
+
+    def adjust_vel(self):
+        adjust_vel_array(self.vel)
+
+    def adjust_pos(self):
+        adjust_pos_array(self.pos, self.screen_size)
+
+
+def flock_rules(pos, vel, all_pos, all_vel, neighbors, dist_squared, world_size, timer=None):
+    """
+    Velocity change of boids with (N, 2) positions and velocities. Neighbors
+    are (N, k) matrix of indexes to all_pos/all_vel arrays padded with -1,
+    dist_squared is matrix of the same shape.
+    """
+    timer = timer or PhaseTimer()
+
+    with timer.phase('fov'):
+        valid = neighbors >= 0
+        nb_pos = all_pos[neighbors]
+        offset = min_image(nb_pos - pos[:, np.newaxis, :], world_size)
+        valid &= view_mask(vel, offset)
+
+    with timer.phase('rules'):
+        return rules_velocity(vel, all_vel[neighbors], offset, valid, dist_squared)
+
+
+def rules_velocity(vel, nb_vel, offset, valid, dist_squared):
+    """Velocity change from three rules, for (N, k) matrices of visible neighbors."""
+    dist = np.sqrt(np.where(valid, dist_squared, 0))
+    count = valid.sum(axis=1)
+    # Avoid division by zero for boids without neighbors (rules give 0 then)
+    count_div = np.maximum(count, 1)[:, np.newaxis]
+    dist_div = np.where(dist > 0, dist, 1)[:, :, np.newaxis]
+
+    # Rule 1: fly to center
+    avg_dist = dist.sum(axis=1, keepdims=True) / count_div
+    mask = (valid & (dist > MIN_DIST))[:, :, np.newaxis]
+    v1 = (WEIGHT_MIN_DIST / count_div) * np.sum(
+        np.where(mask, offset * (dist - avg_dist)[:, :, np.newaxis] / dist_div, 0), axis=1)
+
+    # Rule 2: keep safe distance
+    mask = (valid & (dist > 0))[:, :, np.newaxis]
+    v2 = -(WEIGHT_NEIGHB_DIST / count_div) * np.sum(
+        np.where(mask, offset * MIN_DIST / dist_div - offset, 0), axis=1)
+
+    # Rule 3: adjust velocity (without neighbors average velocity is 0)
+    avg_vel = np.sum(np.where(valid[:, :, np.newaxis], nb_vel, 0), axis=1) / count_div
+    v3 = WEIGHT_VEL * (avg_vel - vel)
+
+    return v1 + v2 + v3
+
+
+def adjust_vel_array(vel):
+    """Same as Body.adjust_vel for (N, 2) velocities."""
+    slow = np.all(np.absolute(vel) <= Body.EPSILON, axis=1)
+    vel[slow] = np.maximum(vel[slow], MAX_VEL / 10)
+
+
+def adjust_pos_array(pos, world_size):
+    """Screen wrapping, same as Body.adjust_pos for (N, 2) positions."""
+    for axis in range(NUM_AXIS):
+        p = pos[:, axis]
+        size = world_size[axis]
+        p[:] = np.where(p < 0, p % -size + size, np.where(p > size, p % size, p))
+
+
+class FlockBody:
+    """View on single boid in Flock, for code working on Body objects."""
+
+    def __init__(self, flock, idx):
+        self.idx = idx
+        self.pos = flock.pos[idx]
+        self.vel = flock.vel[idx]
+
+
+class FlockPool:
+    """
+    Flock stepping in worker processes. World is split into horizontal
+    strips (by y, with equal number of boids). Every worker steps boids of
+    its strip and sees also boids from halo - bodies closer than VIEW_RADIUS
+    to the strip (with wrapping). Positions and velocities are copied to
+    shared memory, workers write new ones to second buffer, so they don't
+    see each other writes. Pool map joins workers once per frame.
+    """
+
+    def __init__(self, flock, workers, index):
+        self.flock = flock
+        self.workers = workers
+
+        count = len(flock.pos)
+        size = 2 * 2 * count * NUM_AXIS * np.dtype(np.float64).itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.buffers = flock_buffers(self.shm, count)
+        self.pool = mp.Pool(workers, initializer=init_worker,
+                            initargs=(self.shm.name, count, flock.screen_size, index))
+
+    def step(self, timer=None):
+        """Step flock, return number of compares of all local indexes."""
+        timer = timer or PhaseTimer()
+        self.buffers[0, 0] = self.flock.pos
+        self.buffers[0, 1] = self.flock.vel
+
+        edges = np.quantile(self.flock.pos[:, Y_AXIS], np.linspace(0, 1, self.workers + 1)) \
+            if len(self.flock.pos) else np.zeros(self.workers + 1)
+        edges[0] = 0
+        edges[-1] = self.flock.screen_size[Y_AXIS]
+        results = self.pool.map(step_strip, [(num, edges) for num in range(self.workers)])
+        timer.merge([totals for _, totals in results])
+        compares_count = sum(count for count, _ in results)
+
+        self.flock.pos[:] = self.buffers[1, 0]
+        self.flock.vel[:] = self.buffers[1, 1]
+        return compares_count
+
+    def stats(self):
+        """Index stats for status line."""
+        return 'Workers: %d' % self.workers
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        del self.buffers
+        self.shm.close()
+        self.shm.unlink()
+
+
+def flock_buffers(shm, count):
+    """[current, next] x [positions, velocities] buffers in shared memory."""
+    return np.ndarray(shape=(2, 2, count, NUM_AXIS), dtype=np.float64, buffer=shm.buf)
+
+
+# Worker process state, set by init_worker
+_worker = {}
+
+
+def init_worker(shm_name, count, world_size, index):
+    # Ctrl-C is handled by main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['buffers'] = flock_buffers(shm, count)
+    _worker['world_size'] = world_size
+    _worker['index'] = index
+
+
+def step_strip(task):
+    """
+    Step boids from one strip. Return number of compares of local index and
+    time of phases.
+    """
+    num, edges = task
+    timer = PhaseTimer()
+    pos, vel = _worker['buffers'][0]
+    world_size = _worker['world_size']
+    height = world_size[Y_AXIS]
+    begin, end = edges[num], edges[num + 1]
+
+    strip = np.clip(np.searchsorted(edges, pos[:, Y_AXIS], side='right') - 1, 0, len(edges) - 2)
+    own = strip == num
+    halo = ~own & (((begin - pos[:, Y_AXIS]) % height < VIEW_RADIUS) |
+                   ((pos[:, Y_AXIS] - end) % height < VIEW_RADIUS))
+
+    # Owned boids first, so local index skips them as own neighbors
+    own_idx = np.nonzero(own)[0]
+    local_idx = np.concatenate([own_idx, np.nonzero(halo)[0]])
+    local_pos = pos[local_idx]
+    local_vel = vel[local_idx]
+
+    with timer.phase('build'):
+        tree = _worker['index'](local_pos, world_size=world_size)
+    with timer.phase('query'):
+        neighbors, dist_squared = tree.query_all(local_pos[:own_idx.size], VIEW_RADIUS)
+
+    dv = flock_rules(local_pos[:own_idx.size], local_vel[:own_idx.size], local_pos, local_vel,
+                     neighbors, dist_squared, world_size, timer)
+
+    with timer.phase('integrate'):
+        new_vel = local_vel[:own_idx.size] + dv
+        new_pos = local_pos[:own_idx.size] + new_vel * DT
+        adjust_vel_array(new_vel)
+        adjust_pos_array(new_pos, world_size)
+
+        new = _worker['buffers'][1]
+        new[0, own_idx] = new_pos
+        new[1, own_idx] = new_vel
+
+    return tree.compares_count, dict(timer.totals)
+
+
 class KdTree:
     """
     http://web.stanford.edu/class/cs106l/handouts/005_assignment_3_kdtree.pdf
@@ -113,10 +366,18 @@ class KdTree:
             self.node = node
             self.axis = axis
 
-    def __init__(self, bodies, k=25):
+    class Image:
+        """Body shifted by world size, for minimum image search."""
+        def __init__(self, pos):
+            self.pos = pos
+
+    def __init__(self, bodies, k=25, world_size=None):
         self.root = None
+        self.bodies = bodies
         self.k = k
+        self.world_size = world_size
 
+        self.size = len(bodies)
         self.height = 0
         self.compares_count = 0
 
@@ -159,6 +420,12 @@ class KdTree:
             self.height = new_node_height
 
     def nearest(self, body, radius):
+        neighbors = []
+        for query in self._images(body, radius):
+            neighbors += self._nearest(query, radius)
+        return neighbors
+
+    def _nearest(self, body, radius):
         if not self.root:
             return []
 
@@ -202,6 +469,12 @@ class KdTree:
         return tasks
 
     def k_nearest(self, body, radius):
+        neighbors = []
+        for query in self._images(body, radius):
+            neighbors += self._k_nearest(query, radius)
+        return heapq.nsmallest(self.k, neighbors, key=lambda n: n[0])
+
+    def _k_nearest(self, body, radius):
         if not self.root:
             return []
 
@@ -253,6 +526,32 @@ class KdTree:
 
         return tasks
 
+    def query_all(self, positions, radius):
+        """
+        Same contract as BalancedKdTree.query_all, but with one k_nearest call
+        per body. Positions have to be positions of indexed bodies.
+        """
+        neighbors = np.full(shape=(len(positions), self.k), fill_value=-1)
+        dist_squared = np.full(shape=(len(positions), self.k), fill_value=np.inf)
+        body_idx = {id(body): idx for idx, body in enumerate(self.bodies)}
+
+        for idx, body in enumerate(self.bodies[:len(positions)]):
+            for num, (dist_sq, neighb_body) in enumerate(self.k_nearest(body, radius)):
+                neighbors[idx, num] = body_idx[id(neighb_body)]
+                dist_squared[idx, num] = dist_sq
+
+        return neighbors, dist_squared
+
+    def _images(self, body, radius):
+        """Body and its shifted copies (in toroidal world)."""
+        _, images = periodic_images(body.pos[np.newaxis], radius, self.world_size)
+        return [body] + [KdTree.Image(pos) for pos in images[1:]]
+
+    def stats(self):
+        """Index stats for status line."""
+        # Minimal height of binary tree with N nodes is floor(log2(N)) + 1
+        return 'Tree height: %2d, optimal: %d' % (self.height, self.size.bit_length())
+
     def _bpq_max(self, bqp):
         """Bounded priority queue maximal element."""
         return -bqp[0][0]
@@ -261,41 +560,522 @@ class KdTree:
         return (axis + 1) % NUM_AXIS
 
 
-def main(scr):
+class BalancedKdTree:
+    """
+    KdTree built at once by median splits, without Node objects. Tree is
+    stored in implicit layout: bodies indexes are permuted (self.idx), so node
+    of subtree [lo, hi) is at position mid = (lo + hi) // 2, with left subtree
+    in [lo, mid) and right subtree in [mid+1, hi). Height is always
+    floor(log2(N)) + 1.
+    """
+
+    # Above this number of subtrees on one level, full sort is faster than
+    # np.argpartition with many kth
+    MAX_KTH = 64
+
+    def __init__(self, bodies, k=25, world_size=None):
+        self.bodies = bodies
+        self.k = k
+        self.world_size = world_size
+
+        self.size = len(bodies)
+        self.height = 0
+        self.compares_count = 0
+
+        pos = positions_array(bodies)
+        self.idx = self._build(pos)
+        # Positions in tree order. Scalar queries use list copy (indexing
+        # Python lists is faster than ndarray), created on first use
+        self.pos = pos[self.idx].reshape(-1, NUM_AXIS)
+        self._pos_list = None
+
+    def _build(self, pos):
+        """
+        Split all subtrees of one level at once. Subtrees occupy separate
+        ranges, so argpartition of (subtree number, coordinate rank) keys with
+        kth at subtree starts and medians moves median of every subtree to its
+        mid position.
+        """
+        ranks = np.empty(shape=(NUM_AXIS, self.size), dtype=np.int64)
+        for axis in range(NUM_AXIS):
+            ranks[axis, np.argsort(pos[:, axis], kind='stable')] = np.arange(self.size)
+
+        idx = np.arange(self.size)
+        lo = np.array([0])
+        hi = np.array([self.size])
+        axis = Y_AXIS
+
+        while lo.size and self.size:
+            sizes = hi - lo
+            mid = (lo + hi) // 2
+            starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+            subtree = np.repeat(np.arange(lo.size), sizes)
+            positions = np.arange(sizes.sum()) - starts[subtree] + lo[subtree]
+            keys = subtree * self.size + ranks[axis, idx[positions]]
+
+            kth = np.union1d(starts, starts + mid - lo)
+            if kth.size <= self.MAX_KTH:
+                order = np.argpartition(keys, kth)
+            else:
+                order = np.argsort(keys)
+            idx[positions] = idx[positions][order]
+
+            lo, hi = np.concatenate([lo, mid + 1]), np.concatenate([mid, hi])
+            not_empty = hi > lo
+            lo, hi = lo[not_empty], hi[not_empty]
+            sort = np.argsort(lo)
+            lo, hi = lo[sort], hi[sort]
+
+            axis = self._next_axis(axis)
+            self.height += 1
+
+        return idx
+
+    def _node_positions(self):
+        """Positions in tree order as list, for scalar queries."""
+        if self._pos_list is None:
+            self._pos_list = self.pos.tolist()
+        return self._pos_list
+
+    def nearest(self, body, radius):
+        neighbors = []
+        radius_squared = radius**2
+        nodes_pos = self._node_positions()
+
+        stack = self._start_tasks(body, radius)
+        while stack:
+            lo, hi, axis, pos = stack.pop()
+            if lo >= hi:
+                continue
+            self.compares_count += 1
+
+            mid = (lo + hi) // 2
+            node_pos = nodes_pos[mid]
+            node_body = self.bodies[self.idx[mid]]
+
+            if node_body is not body:
+                dist_squared = distance_squared(pos, node_pos)
+                if dist_squared < radius_squared:
+                    neighbors.append((dist_squared, node_body))
+
+            stack.extend(self._new_tasks(lo, mid, hi, axis, pos, pos[axis] - node_pos[axis], radius))
+
+        return neighbors
+
+    def k_nearest(self, body, radius):
+        """Up to k nearest bodies in radius. Search radius shrinks when k bodies are found."""
+        neighbors = []
+        radius_squared = radius**2
+        nodes_pos = self._node_positions()
+
+        stack = self._start_tasks(body, radius)
+        while stack:
+            lo, hi, axis, pos = stack.pop()
+            if lo >= hi:
+                continue
+            self.compares_count += 1
+
+            mid = (lo + hi) // 2
+            node_pos = nodes_pos[mid]
+            node_body = self.bodies[self.idx[mid]]
+
+            if node_body is not body:
+                dist_squared = distance_squared(pos, node_pos)
+                if dist_squared < radius_squared:
+                    if len(neighbors) < self.k:
+                        heapq.heappush(neighbors, (-dist_squared, self.idx[mid]))
+                    else:
+                        heapq.heapreplace(neighbors, (-dist_squared, self.idx[mid]))
+                    if len(neighbors) == self.k:
+                        radius_squared = -neighbors[0][0]
+                        radius = math.sqrt(radius_squared)
+
+            stack.extend(self._new_tasks(lo, mid, hi, axis, pos, pos[axis] - node_pos[axis], radius))
+
+        return [(-d, self.bodies[idx]) for d, idx in neighbors]
+
+    def query_all(self, positions, radius):
+        """
+        Up to k nearest indexed bodies in radius for every position in (N, 2)
+        array. Row i skips indexed body i (when positions are positions of
+        indexed bodies, body isn't its own neighbor). Return (N, k) matrix of
+        neighbor indexes padded with -1 and matrix of squared distances padded
+        with inf.
+
+        All queries walk the tree together, level by level. Frontier keeps
+        (query, lo, hi) of subtrees to visit, nodes on one level share split
+        axis, so distance test and choice of children is vectorized. Queries
+        are images of positions (see periodic_images).
+        """
+        pts = self.pos
+        radius_squared = radius**2
+        owner, images = periodic_images(positions, radius, self.world_size)
+
+        query = np.arange(len(images))
+        lo = np.zeros_like(query)
+        hi = np.full_like(query, self.size)
+        axis = Y_AXIS
+        hits = []
+
+        while query.size:
+            not_empty = hi > lo
+            query, lo, hi = query[not_empty], lo[not_empty], hi[not_empty]
+            self.compares_count += query.size
+
+            mid = (lo + hi) // 2
+            node = self.idx[mid]
+            offset = pts[mid] - images[query]
+            dist_squared = np.sum(offset**2, axis=1)
+
+            hit = (dist_squared < radius_squared) & (node != owner[query])
+            hits.append((owner[query[hit]], node[hit], dist_squared[hit]))
+
+            # Subtree on the side of position, and other one if it's in radius
+            diff = -offset[:, axis]
+            left = diff < 0
+            far = np.fabs(diff) < radius
+            query = np.concatenate([query, query[far]])
+            lo = np.concatenate([np.where(left, lo, mid + 1), np.where(left, mid + 1, lo)[far]])
+            hi = np.concatenate([np.where(left, mid, hi), np.where(left, hi, mid)[far]])
+            axis = self._next_axis(axis)
+
+        query, node, dist_squared = (np.concatenate(h) for h in zip(*hits)) if hits else \
+            (np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0))
+        return pad_neighbors(query, node, dist_squared, len(positions), self.k)
+
+    def _start_tasks(self, body, radius):
+        """Whole tree for body and its shifted copies (in toroidal world)."""
+        _, images = periodic_images(body.pos[np.newaxis], radius, self.world_size)
+        return [(0, self.size, Y_AXIS, pos) for pos in images.tolist()]
+
+    def _new_tasks(self, lo, mid, hi, axis, pos, diff, radius):
+        """Subtree on the side of body, and other one if it's in radius."""
+        next_axis = self._next_axis(axis)
+        left = (lo, mid, next_axis, pos)
+        right = (mid + 1, hi, next_axis, pos)
+
+        if diff < 0:
+            near, far = left, right
+        else:
+            near, far = right, left
+
+        if math.fabs(diff) < radius:
+            return [near, far]
+        return [near]
+
+    def stats(self):
+        """Index stats for status line."""
+        # Minimal height of binary tree with N nodes is floor(log2(N)) + 1
+        return 'Tree height: %2d, optimal: %d' % (self.height, self.size.bit_length())
+
+    def _next_axis(self, axis):
+        return (axis + 1) % NUM_AXIS
+
+
+class SpatialHash:
+    """
+    Uniform grid (cell list) with cell size equal to query radius, so all
+    neighbors of body are in 3x3 cells around it. Bodies are bucketed by cell
+    ids: bincount gives bucket sizes, cumulative sum gives bucket starts and
+    stable argsort orders bodies indexes into buckets. Ids are narrowed to the
+    smallest unsigned type, for up to 2**16 cells NumPy does stable argsort as
+    radix sort (byte-wise counting sort), so build is O(N). Bigger grids fall
+    back to O(N log N) comparison sort. Same nearest/k_nearest contract as
+    KdTree.
+    """
+
+    def __init__(self, bodies, k=25, radius=VIEW_RADIUS, world_size=None):
+        self.bodies = bodies
+        self.k = k
+        self.radius = radius
+        self.world_size = world_size
+        self.compares_count = 0
+
+        self.pos = positions_array(bodies)
+        cells = np.floor(self.pos / radius).astype(int)
+        self.origin = cells.min(axis=0, initial=0)
+        cells -= self.origin
+        self.shape = cells.max(axis=0, initial=0) + 1
+
+        num_cells = self.shape[Y_AXIS] * self.shape[X_AXIS]
+        cell_ids = cells[:, Y_AXIS] * self.shape[X_AXIS] + cells[:, X_AXIS]
+        counts = np.bincount(cell_ids, minlength=num_cells)
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+        cell_ids = cell_ids.astype(np.min_scalar_type(num_cells - 1))
+        self.order = np.argsort(cell_ids, kind='stable')
+
+    def nearest(self, body, radius):
+        assert radius <= self.radius, 'Radius bigger than cell size'
+
+        neighbors = []
+        _, images = periodic_images(body.pos[np.newaxis], radius, self.world_size)
+        for pos in images:
+            candidates = self._candidates(pos)
+            self.compares_count += len(candidates)
+
+            dist_squared = distance_squared_array(self.pos[candidates], pos)
+            hits = dist_squared < radius**2
+
+            neighbors += [(dist_sq, self.bodies[idx]) for dist_sq, idx in zip(dist_squared[hits], candidates[hits])
+                          if self.bodies[idx] is not body]
+
+        return neighbors
+
+    def k_nearest(self, body, radius):
+        neighbors = self.nearest(body, radius)
+        if len(neighbors) > self.k:
+            neighbors = heapq.nsmallest(self.k, neighbors, key=lambda n: n[0])
+        return neighbors
+
+    def query_all(self, positions, radius):
+        """
+        Same contract as BalancedKdTree.query_all. Candidates from 3x3 cells
+        around every position (and image) are expanded at once, from three
+        ranges (rows of cells) per position.
+        """
+        assert radius <= self.radius, 'Radius bigger than cell size'
+
+        owner, images = periodic_images(positions, radius, self.world_size)
+        cells = np.floor(images / self.radius).astype(int) - self.origin
+        x_begin = np.clip(cells[:, X_AXIS] - 1, 0, self.shape[X_AXIS] - 1)
+        x_end = np.clip(cells[:, X_AXIS] + 1, 0, self.shape[X_AXIS] - 1)
+
+        begins = []
+        ends = []
+        for dy in (-1, 0, 1):
+            y = cells[:, Y_AXIS] + dy
+            # Rows outside of grid give empty ranges
+            inside = (y >= 0) & (y < self.shape[Y_AXIS]) & (x_begin <= x_end)
+            row = np.clip(y, 0, self.shape[Y_AXIS] - 1) * self.shape[X_AXIS]
+            begins.append(self.starts[row + x_begin])
+            ends.append(np.where(inside, self.starts[row + x_end + 1], self.starts[row + x_begin]))
+
+        begins = np.concatenate(begins)
+        counts = np.concatenate(ends) - begins
+        query = np.repeat(np.tile(np.arange(len(images)), 3), counts)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        node = self.order[np.repeat(begins, counts) + np.arange(counts.sum()) - first]
+        self.compares_count += node.size
+
+        dist_squared = np.sum((self.pos[node] - images[query])**2, axis=1)
+        query = owner[query]
+        hit = (dist_squared < radius**2) & (node != query)
+        return pad_neighbors(query[hit], node[hit], dist_squared[hit], len(positions), self.k)
+
+    def _candidates(self, pos):
+        """Bodies indexes from 3x3 cells around position."""
+        cy, cx = np.floor(pos / self.radius).astype(int) - self.origin
+        # Periodic image can be outside of grid, clip range like query_all
+        x_begin = min(max(cx - 1, 0), self.shape[X_AXIS] - 1)
+        x_end = min(max(cx + 1, 0), self.shape[X_AXIS] - 1)
+        if x_begin > x_end:
+            return np.empty(0, dtype=int)
+
+        ranges = []
+        for y in range(max(cy - 1, 0), min(cy + 1, self.shape[Y_AXIS] - 1) + 1):
+            # Cells in the same row have consecutive ids
+            row = y * self.shape[X_AXIS]
+            ranges.append(self.order[self.starts[row + x_begin]:self.starts[row + x_end + 1]])
+
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=int)
+
+    def stats(self):
+        """Index stats for status line."""
+        return 'Cells: %dx%d' % tuple(self.shape)
+
+
+INDEXES = {
+    'kdtree': KdTree,
+    'balanced': BalancedKdTree,
+    'hash': SpatialHash,
+}
+
+
+def main(scr, args):
     setup_stderr('/dev/pts/1')
     setup_curses(scr)
 
     # np.random.seed(3145)
     screen_size = np.array([curses.LINES*4, (curses.COLS-1)*2])
-    bodies = [Body(screen_size) for _ in range(BODY_COUNT)]
-
-    while True:
-        tic = time.time()
-        tree = KdTree(bodies)
+    pool = None
+    if args.engine == 'flock':
+        flock = Flock(screen_size, args.count)
+        bodies = flock.bodies
+        if args.workers:
+            pool = FlockPool(flock, args.workers, INDEXES[args.index])
+    else:
+        bodies = [Body(screen_size) for _ in range(args.count)]
+
+    trace_file = open(args.trace, 'w', newline='') if args.trace else None
+    if trace_file:
+        trace = csv.writer(trace_file)
+        trace.writerow(['frame', 'bodies'] + [name + '_ms' for name in PHASES])
+
+    frame = 0
+    overlay = None
+    try:
+        while True:
+            tic = time.time()
+            timer = PhaseTimer()
+
+            if pool:
+                compares_count = pool.step(timer)
+                index_stats = pool.stats()
+            else:
+                with timer.phase('build'):
+                    tree = INDEXES[args.index](bodies, world_size=screen_size)
+
+                if args.engine == 'flock':
+                    with timer.phase('query'):
+                        neighbors, dist_squared = tree.query_all(flock.pos, VIEW_RADIUS)
+                    flock.step(neighbors, dist_squared, timer)
+                else:
+                    step_bodies(tree, bodies, timer)
+
+                compares_count = tree.compares_count
+                index_stats = tree.stats()
+
+            calc_time = time.time() - tic
+
+            positions = flock.pos if args.engine == 'flock' else np.array([body.pos for body in bodies])
+            draw(scr, screen_size, positions, index_stats=index_stats,
+                compares_count=compares_count, calc_time=calc_time, timer=timer, overlay=overlay)
+
+            # Overlay shows previous frame, with its rasterize and write times
+            if args.stats:
+                overlay = phases_line(timer.totals)
+            if trace_file:
+                trace.writerow([frame, len(positions)] + ['%.3f' % (timer.totals[name] * 1000) for name in PHASES])
+            frame += 1
+    finally:
+        if pool:
+            pool.close()
+        if trace_file:
+            trace_file.close()
+
+
+def benchmark(frames, world_size, seed, counts):
+    """
+    Step flock engine without screen, for every flock size and neighbor
+    index. Every index gets the same initial flock (same seed). Report
+    frames/sec, mean neighbors (found by index) per boid and compares per
+    query.
+    """
+    print('World: %dx%d, frames: %d, seed: %d' % (world_size[Y_AXIS], world_size[X_AXIS], frames, seed))
+    print('%-8s %-9s %10s %10s %10s' % ('bodies', 'index', 'frames/s', 'neighbors', 'cmp/query'))
 
-        for body in bodies:
-            candidates = tree.k_nearest(body, VIEW_RADIUS)
+    for count in counts:
+        for name in sorted(INDEXES):
+            if name == 'kdtree' and count > BENCHMARK_KDTREE_MAX:
+                print('%-8d %-9s %10s' % (count, name, 'skipped'))
+                continue
 
+            np.random.seed(seed)
+            flock = Flock(world_size, count)
+            neighbors_count = 0
+            compares_count = 0
+
+            tic = time.perf_counter()
+            for _ in range(frames):
+                tree = INDEXES[name](flock.bodies, world_size=world_size)
+                neighbors, dist_squared = tree.query_all(flock.pos, VIEW_RADIUS)
+                flock.step(neighbors, dist_squared)
+
+                neighbors_count += np.count_nonzero(neighbors >= 0)
+                compares_count += tree.compares_count
+            elapsed = time.perf_counter() - tic
+
+            queries = max(count * frames, 1)
+            print('%-8d %-9s %10.2f %10.2f %10.1f' % (count, name, frames / elapsed,
+                neighbors_count / queries, compares_count / queries))
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Boids in terminal.')
+    parser.add_argument('-e', '--engine', choices=['bodies', 'flock'], default='flock',
+                        help='Body objects or flock arrays (structure of arrays).')
+    parser.add_argument('-i', '--index', choices=sorted(INDEXES), default='balanced',
+                        help='Neighbor index.')
+    parser.add_argument('-n', '--count', type=int, default=BODY_COUNT,
+                        help='Number of boids.')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Step flock in worker processes (flock engine, balanced or hash index).')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='Show time of frame phases below status line.')
+    parser.add_argument('-t', '--trace', metavar='FILE',
+                        help='Write time of frame phases to CSV file.')
+    parser.add_argument('-b', '--benchmark', type=int, metavar='FRAMES', default=0,
+                        help='Run headless benchmark (flock engine) for every flock size and index.')
+    parser.add_argument('--world', type=int, nargs=2, metavar=('HEIGHT', 'WIDTH'), default=[1000, 2000],
+                        help='World size for benchmark.')
+    parser.add_argument('--seed', type=int, default=3145,
+                        help='Random seed for benchmark.')
+    parser.add_argument('--counts', type=int, nargs='+', default=BENCHMARK_COUNTS,
+                        help='Flock sizes for benchmark.')
+    args = parser.parse_args()
+
+    if args.workers and (args.engine != 'flock' or args.index == 'kdtree'):
+        parser.error('--workers needs flock engine and balanced or hash index')
+
+    return args
+
+
+def step_bodies(tree, bodies, timer=None):
+    """Apply rules and move Body objects."""
+    timer = timer or PhaseTimer()
+
+    with timer.phase('query'):
+        candidates = [tree.k_nearest(body, VIEW_RADIUS) for body in bodies]
+
+    with timer.phase('fov'):
+        for body, body_candidates in zip(bodies, candidates):
             body.neighbors = []
-            for dist_squared, neighb_body in candidates:
+            for dist_squared, neighb_body in body_candidates:
                 angle = view_angle_2d(body, neighb_body)
-                if angle < VIEW_ANGLE:
+                if angle < VIEW_ANGLE/2:
                     body.neighbors.append((math.sqrt(dist_squared), neighb_body))
 
+    with timer.phase('rules'):
+        for body in bodies:
             body.v1 = rule1_fly_to_center(body)
             body.v2 = rule2_keep_safe_dist(body)
             body.v3 = rule3_adjust_velocity(body)
 
+    with timer.phase('integrate'):
         for body in bodies:
             body.vel += body.v1 + body.v2 + body.v3
             body.pos += body.vel * DT
             body.adjust()
 
-        calc_time = time.time() - tic
 
-        draw(scr, screen_size, bodies, tree_height=tree.height,
-            optimal_height=math.ceil(math.log(len(bodies), 2)),
-            compares_count=tree.compares_count, calc_time=calc_time)
+def positions_array(bodies):
+    """(N, 2) array of bodies positions. Bodies can be also positions array."""
+    if isinstance(bodies, np.ndarray):
+        return bodies
+    return np.array([body.pos for body in bodies]).reshape(-1, NUM_AXIS)
+
+
+def pad_neighbors(query, node, dist_squared, count, k):
+    """
+    Pack (query, node, dist_squared) hits into (count, k) matrices, with up to
+    k nearest nodes per query. Padded with -1 and inf.
+    """
+    neighbors = np.full(shape=(count, k), fill_value=-1)
+    dist_matrix = np.full(shape=(count, k), fill_value=np.inf)
+
+    order = np.lexsort((dist_squared, query))
+    query, node, dist_squared = query[order], node[order], dist_squared[order]
+
+    # Rank of hit among hits of the same query
+    starts = np.searchsorted(query, np.arange(count))
+    rank = np.arange(query.size) - starts[query]
+    keep = rank < k
+
+    neighbors[query[keep], rank[keep]] = node[keep]
+    dist_matrix[query[keep], rank[keep]] = dist_squared[keep]
+    return neighbors, dist_matrix
 
 
 def setup_curses(scr):
@@ -327,7 +1107,8 @@ def rule1_fly_to_center(body):
     v = 0
     for dist, neighb_body in body.neighbors:
         if dist > MIN_DIST:
-            v += weight * (((neighb_body.pos - body.pos) * (dist - avg_dist)) / dist)
+            offset = min_image(neighb_body.pos - body.pos, body.screen_size)
+            v += weight * ((offset * (dist - avg_dist)) / dist)
 
     return v
 
@@ -338,7 +1119,8 @@ def rule2_keep_safe_dist(body):
 
     v = 0
     for dist, neighb_body in body.neighbors:
-        v += -weight * ((((neighb_body.pos - body.pos) * MIN_DIST) / dist) - (neighb_body.pos - body.pos))
+        offset = min_image(neighb_body.pos - body.pos, body.screen_size)
+        v += -weight * (((offset * MIN_DIST) / dist) - offset)
 
     return v
 
@@ -355,14 +1137,76 @@ def distance_squared(pos1, pos2):
     return (pos1[0] - pos2[0])**2 + (pos1[1] - pos2[1])**2
 
 
+def distance_squared_array(positions, pos):
+    """Squared distances between (N, 2) positions and single position."""
+    return (positions[:, 0] - pos[0])**2 + (positions[:, 1] - pos[1])**2
+
+
+def min_image(offset, world_size):
+    """Shortest offset between bodies in toroidal world (minimum image convention)."""
+    return offset - world_size * np.round(offset / world_size)
+
+
+def periodic_images(positions, radius, world_size):
+    """
+    Positions and their copies shifted by world size, for minimum image
+    search in toroidal world. Only positions closer than radius to world edge
+    need shifted copies (up to three near corner), so cost stays close to
+    non-periodic search. Return (owner, images) - index of original position
+    for every image and (M, 2) array of images, original positions first.
+    Without world size (not periodic) images are just positions.
+    """
+    owner = np.arange(len(positions))
+    if world_size is None:
+        return owner, positions
+
+    # Body can't be in radius of two images of the same position
+    assert np.all(2*radius <= world_size), 'Radius bigger than half of world'
+
+    shifts = []
+    for axis in range(NUM_AXIS):
+        size = world_size[axis]
+        shifts.append([(0, np.ones(len(positions), dtype=bool)),
+                       (size, positions[:, axis] < radius),
+                       (-size, positions[:, axis] > size - radius)])
+
+    owners = []
+    images = []
+    for shift_y, mask_y in shifts[Y_AXIS]:
+        for shift_x, mask_x in shifts[X_AXIS]:
+            mask = mask_y & mask_x
+            owners.append(owner[mask])
+            images.append(positions[mask] + [shift_y, shift_x])
+
+    return np.concatenate(owners), np.concatenate(images)
+
+
 def view_angle_2d(body1, body2):
+    offset = min_image(body2.pos - body1.pos, body1.screen_size)
     k1 = math.atan2(body1.vel[0], body1.vel[1])
-    k2 = math.atan2(body2.pos[0] - body1.pos[0], body2.pos[1] - body1.pos[1])
+    k2 = math.atan2(offset[0], offset[1])
 
+    # Angle between directions, wrapped to [0, pi]
     diff = math.fabs(k1 - k2)
+    if diff > math.pi:
+        diff = 2*math.pi - diff
     return diff
 
 
+def view_mask(vel, offset):
+    """
+    Mask of neighbors in field of view, for (N, 2) velocities and (N, k, 2)
+    offsets to neighbors. Angle between velocity and offset is less than
+    VIEW_ANGLE/2 when cosine of it is bigger than cos(VIEW_ANGLE/2), so
+    dot product is compared instead of angles. Boid without velocity sees
+    everything around.
+    """
+    dot = np.sum(vel[:, np.newaxis, :] * offset, axis=2)
+    vel_norm = np.sqrt(np.sum(vel**2, axis=1))[:, np.newaxis]
+    offset_norm = np.sqrt(np.sum(offset**2, axis=2))
+    return dot >= VIEW_COS * vel_norm * offset_norm
+
+
 def view_angle_nd(body1, body2):
     """Terrible, terrible slows."""
     mag_vec1 = np.sum(body1.vel**2)**0.5
@@ -371,41 +1215,59 @@ def view_angle_nd(body1, body2):
     return angle
 
 
-def draw(scr, screen_size, bodies, tree_height, optimal_height, compares_count, calc_time):
-    buf = symbol_array(bodies, screen_size)
+def draw(scr, screen_size, positions, index_stats, compares_count, calc_time, timer=None, overlay=None):
+    timer = timer or PhaseTimer()
 
-    dtype = np.dtype('U' + str(buf.shape[1]))
-    for num, line in enumerate(buf):
-        scr.addstr(num, 0, line.view(dtype)[0])
+    with timer.phase('rasterize'):
+        lines = symbol_array(positions, screen_size, shape=[curses.LINES, curses.COLS - 1])
 
-    scr.addstr(0, 0, 'Total bodies: %d. Tree height: %2d, optimal: %d. Cmp: %5d. Calc time: %.4f sec' %
-        (len(bodies), tree_height, optimal_height, compares_count, calc_time))
+    with timer.phase('write'):
+        for num, line in enumerate(lines):
+            scr.addstr(num, 0, line)
 
-    scr.refresh()
+        scr.addstr(0, 0, 'Total bodies: %d. %s. Cmp: %5d. Calc time: %.4f sec' %
+            (len(positions), index_stats, compares_count, calc_time))
+        if overlay and curses.LINES > 1:
+            scr.addstr(1, 0, overlay[:curses.COLS - 1])
 
+        scr.refresh()
 
-def symbol_array(bodies, screen_size):
-    shape = [curses.LINES, curses.COLS - 1]
-    count = np.zeros(shape=shape)
 
-    for b in bodies:
-        if 0 <= b.pos[0] < screen_size[0] and 0 <= b.pos[1] < screen_size[1]:
-            count[int(b.pos[0]//4), int(b.pos[1]//2)] += 1
+def phases_line(totals):
+    """Time of frame phases (in ms) for status overlay."""
+    return ' '.join('%s: %.1f' % (name, totals[name] * 1000) for name in PHASES) + ' ms'
 
-    buf = np.full(shape=shape, fill_value=' ')
-    for y in range(count.shape[0]):
-        for x in range(count.shape[1]):
-            if count[y][x] == 0:
-                continue
 
-            for threshold, symbol in TONE_SYMBOLS:
-                if count[y][x] >= threshold:
-                    buf[y][x] = symbol
-                    break
+def symbol_array(positions, screen_size, shape):
+    """
+    Rasterize (N, 2) positions into screen lines. Bodies are counted per
+    cell (4x2 units) with bincount and count is mapped to symbol by lookup
+    table.
+    """
+    inside = np.all((positions >= 0) & (positions < screen_size), axis=1)
+    cells = (positions[inside] // [4, 2]).astype(int)
+    count = np.bincount(cells[:, Y_AXIS] * shape[X_AXIS] + cells[:, X_AXIS],
+                        minlength=shape[Y_AXIS] * shape[X_AXIS])
+
+    lut = tone_lut()
+    buf = lut[np.minimum(count, len(lut) - 1)].reshape(shape)
+
+    dtype = np.dtype('U' + str(shape[X_AXIS]))
+    return buf.view(dtype)[:, 0].tolist()
+
 
-    return buf
+def tone_lut():
+    """Symbols indexed by number of bodies in cell (last one for all bigger counts)."""
+    lut = np.full(shape=max(t for t, _ in TONE_SYMBOLS) + 1, fill_value=' ')
+    for threshold, symbol in sorted(TONE_SYMBOLS):
+        lut[threshold:] = symbol
+    return lut
 
 
 if __name__ == '__main__':
-    locale.setlocale(locale.LC_ALL, '')
-    curses.wrapper(main)
+    args = parse_args()
+    if args.benchmark:
+        benchmark(args.benchmark, np.array(args.world), args.seed, args.counts)
+    else:
+        locale.setlocale(locale.LC_ALL, '')
+        curses.wrapper(main, args)
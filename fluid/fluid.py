@@ -19,20 +19,34 @@ Credits:
 
 import os
 import sys
+import tty
+import termios
+import argparse
 import time
 import random
-import itertools as it
+import contextlib
+import collections as co
 import ctypes as ct
 import matplotlib.cm as cm
 import numpy as np
 
 
 # Engine parameters
-GRID_SIZE = 46+2         # Grid size with boundaries around fluid
+GRID_SIZE = 46+2         # Default grid size with boundaries around fluid (no screen)
 SOLVER_ITERATIONS = 4
+MG_TOLERANCE = 1e-4      # Multigrid stop condition: residual relative to divergence
+MG_MAX_CYCLES = 10
+MG_SMOOTH_STEPS = 2
 BND_NONE = 0
 BND_VERTICAL = 1
 BND_HORIZONTAL = 2
+DT = 0.1
+JET_HALF_WIDTH = 5       # Burner jet spans 2*JET_HALF_WIDTH+1 cells around the middle
+MIN_WIDTH = 2*JET_HALF_WIDTH + 1
+
+# Recording parameters
+RECORD_DENSITY_SCALE = 50       # uint8 frames keep colors of render_fluid_with_blocks
+RECORD_VELOCITY_RANGE = 20      # uint8 frames keep velocity in [-range, range]
 
 
 # Screen parameters
@@ -41,6 +55,18 @@ SPARE_FOR_DEFAULT_COLORS = 2
 X_SHIFT = 0
 Y_SHIFT = 0
 LOWER_HALF_BLOCK = u'\u2584'
+INFO_WIDTH = 36          # Debug info next to aquarium
+
+# Golden ratio thresholds for render_fluid_with_chars: (threshold, char, fg scale)
+CHAR_THRESHOLDS = [
+    (97, ' ', 12),
+    (158, '.', 24),
+    (195, '-', 36),
+    (218, 'o', 48),
+    (232, 'X', 60),
+    (241, '%', 72),
+    (256, '@', 84),
+]
 
 # Debug parameters
 # DEBUG = open('/dev/pts/1', 'w')
@@ -49,74 +75,354 @@ LOWER_HALF_BLOCK = u'\u2584'
 def main():
     if 'DEBUG' in globals():
         sys.stderr = DEBUG
-    random.seed(81227)
+    args = parse_args()
+
+    if args.compare:
+        compare_solvers(args.compare, dt=DT, width=args.width or GRID_SIZE-2,
+                        height=args.height or GRID_SIZE-2)
+        return
+
+    if args.headless:
+        benchmark(args.headless, SOLVERS[args.solver](), dt=DT,
+                  width=args.width or GRID_SIZE-2, height=args.height or GRID_SIZE-2)
+        return
+
+    if args.record:
+        record(args.record, args.frames, SOLVERS[args.solver](), dt=DT,
+               width=args.width or GRID_SIZE-2, height=args.height or GRID_SIZE-2,
+               dtype=args.record_dtype, velocity=args.record_velocity)
+        return
+
+    if args.replay:
+        replay(args.replay, fps=args.fps, ansi=args.ansi)
+        return
 
-    screen = Screen(colormap=cm.viridis, mode='matplotlib')
-    # screen = Screen(colormap=cm.viridis, mode='green')
+    random.seed(81227)
 
-    fluid = Fluid(diffusion=0.001, viscosity=0.0001)
-    fluid.add_density(x=GRID_SIZE//2, y=GRID_SIZE-2, amount=200)
+    # By default fill whole terminal. One cell of aquarium has two rows of fluid
+    # (LOWER_HALF_BLOCK), borders take two columns and two lines. Last column is
+    # left empty - ncurses can't print in bottom-right corner.
+    lines, cols = terminal_size()
+    max_width, max_height = cols - 3, 2 * (lines - 2)
+    width = args.width or max_width
+    height = args.height or max_height
+    if max_width < MIN_WIDTH or max_height <= 0:
+        sys.exit('Terminal too small, need at least %d columns and 3 lines.' % (MIN_WIDTH + 3))
+    if width > max_width or height > max_height:
+        sys.exit('Fluid %dx%d doesn\'t fit terminal, max size is %dx%d.'
+                 % (width, height, max_width, max_height))
+
+    screen_class = AnsiScreen if args.ansi else Screen
+    screen = screen_class(colormap=cm.viridis, mode='matplotlib')
+    # screen = screen_class(colormap=cm.viridis, mode='green')
+
+    fluid = create_fluid(width, height)
+    solver = SOLVERS[args.solver]()
 
     # Print aquarium borders
-    render_aquarium_borders(screen)
+    render_aquarium_borders(screen, fluid)
+    pairs = None
+
+    try:
+        while True:
+            tic = time.time()
+
+            burn(fluid)
+            step(fluid, solver, DT)
 
-    dt = 0.1
+            pairs = render_fluid_with_blocks(screen, fluid, pairs)
+            # render_fluid_with_chars(screen, fluid)
 
-    while True:
-        tic = time.time()
+            # Sleep only if extra time left
+            delay = max(0, DT - (time.time() - tic))
+            time.sleep(delay)
+
+            screen.refresh()
+    except KeyboardInterrupt:
+        pass
+
+    screen.endwin()
 
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Fluid simulation in terminal.')
+    parser.add_argument('-s', '--solver', choices=sorted(SOLVERS), default='numpy',
+                        help='Solver backend.')
+    parser.add_argument('-c', '--compare', type=int, metavar='STEPS', default=0,
+                        help='Run STEPS seeded steps on every solver backend and '
+                             'compare them with the reference one (no screen).')
+    parser.add_argument('-b', '--headless', type=int, metavar='STEPS', default=0,
+                        help='Run STEPS steps without screen and report steps/sec '
+                             'with time spent in each phase.')
+    parser.add_argument('-r', '--record', metavar='PATH',
+                        help='Run simulation without screen and save frames to PATH (.npy).')
+    parser.add_argument('-f', '--frames', type=int, default=500,
+                        help='Number of recorded frames.')
+    parser.add_argument('--record-dtype', choices=['float16', 'uint8'], default='float16',
+                        help='Recorded frame type, uint8 is quantized.')
+    parser.add_argument('--record-velocity', action='store_true',
+                        help='Record also velocity fields.')
+    parser.add_argument('-p', '--replay', metavar='PATH',
+                        help='Play frames recorded with --record.')
+    parser.add_argument('--fps', type=float, default=1/DT,
+                        help='Replay frames per second.')
+    parser.add_argument('-a', '--ansi', action='store_true',
+                        help='Write 24-bit ANSI codes directly to terminal instead of ncurses.')
+    parser.add_argument('-W', '--width', type=int,
+                        help='Number of fluid cells in row (default: terminal width).')
+    parser.add_argument('-H', '--height', type=int,
+                        help='Number of fluid cells in column, must be even '
+                             '(default: twice the terminal height).')
+    args = parser.parse_args()
+
+    if args.width is not None and args.width < MIN_WIDTH:
+        parser.error('width must be at least %d (burner jet span).' % MIN_WIDTH)
+    if args.height is not None and args.height <= 0:
+        parser.error('height must be positive.')
+    if args.height and args.height % 2:
+        parser.error('height must be even (two fluid cells per character).')
+
+    return args
+
+
+def terminal_size():
+    """Terminal size as (lines, cols)."""
+    size = os.get_terminal_size()
+    return size.lines, size.columns
+
+
+def create_fluid(width, height):
+    """Fluid with initial density source at the bottom of aquarium."""
+    fluid = Fluid(diffusion=0.001, viscosity=0.0001, width=width+2, height=height+2)
+    fluid.add_density(x=fluid.width//2, y=fluid.height-2, amount=200)
+    return fluid
+
+
+def step(fluid, solver, dt, timer=None):
+    """Single simulation step (velocity step and density step)."""
+    timer = timer or PhaseTimer()
+
+    # Velocity step
+    fluid.swap_velocity()
+    with timer.phase('diffuse'):
+        solver.diffuse(BND_VERTICAL, fluid.vel_x, fluid.vel_x0, fluid.viscosity, dt)
+        solver.diffuse(BND_HORIZONTAL, fluid.vel_y, fluid.vel_y0, fluid.viscosity, dt)
+
+    with timer.phase('project'):
+        solver.project(fluid.vel_x, fluid.vel_y, fluid.vel_x0, fluid.vel_y0)
+
+    fluid.swap_velocity()
+    with timer.phase('advect'):
+        solver.advect(BND_VERTICAL, fluid.vel_x, fluid.vel_x0, fluid.vel_x0, fluid.vel_y0, dt)
+        solver.advect(BND_HORIZONTAL, fluid.vel_y, fluid.vel_y0, fluid.vel_x0, fluid.vel_y0, dt)
+
+    with timer.phase('project'):
+        solver.project(fluid.vel_x, fluid.vel_y, fluid.vel_x0, fluid.vel_y0)
+
+    # Density step
+
+    # We try to find the densities which, when diffused backward in time,
+    # gives the density we started with.
+    # For each grid cell of the latter we trace the cell’s center
+    # position backwards through the velocity field.
+    fluid.swap_density()
+    with timer.phase('diffuse'):
+        solver.diffuse(BND_NONE, fluid.density, fluid.density0, fluid.diffusion, dt)
+    fluid.swap_density()
+    with timer.phase('advect'):
+        solver.advect(BND_NONE, fluid.density, fluid.density0, fluid.vel_x, fluid.vel_y, dt)
+
+
+class PhaseTimer:
+    """Accumulate wall time spent in named phases."""
+
+    def __init__(self):
+        self.totals = co.defaultdict(float)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        tic = time.perf_counter()
+        yield
+        self.totals[name] += time.perf_counter() - tic
+
+
+def benchmark(steps, solver, dt, width, height):
+    """
+    Run simulation without screen and report solver throughput with time
+    breakdown per phase.
+    """
+    random.seed(81227)
+    fluid = create_fluid(width, height)
+    timer = PhaseTimer()
+
+    tic = time.perf_counter()
+    for _ in range(steps):
+        with timer.phase('burn'):
+            burn(fluid)
+        step(fluid, solver, dt, timer)
+        with timer.phase('render-prep'):
+            encode_blocks(fluid.density[1:-1, 1:-1], 50)
+    elapsed = time.perf_counter() - tic
+
+    print('Solver: %s, grid: %dx%d, steps: %d' % (type(solver).__name__, width, height, steps))
+    print('Steps/sec: %.2f' % (steps / elapsed))
+    print('%-12s %10s %10s %7s' % ('phase', 'total [s]', 'ms/step', '%'))
+    for name in ('burn', 'diffuse', 'project', 'advect', 'render-prep'):
+        total = timer.totals[name]
+        print('%-12s %10.4f %10.4f %6.1f%%' % (name, total, 1000 * total / steps, 100 * total / elapsed))
+
+    if isinstance(solver, MultigridSolver) and solver.solves:
+        print('Multigrid: %.2f cycles/solve, last residual: %.2e, solves at cycle limit: %d/%d'
+              % (solver.total_cycles / solver.solves, solver.residual, solver.limit_hits, solver.solves))
+
+
+def record(path, frames, solver, dt, width, height, dtype, velocity):
+    """
+    Run simulation without screen and write density (and optionally velocity)
+    of every step to memory-mapped .npy file with shape (frames, fields,
+    height, width).
+    """
+    random.seed(81227)
+    fluid = create_fluid(width, height)
+
+    fields = 3 if velocity else 1
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                    shape=(frames, fields, fluid.height, fluid.width))
+
+    tic = time.perf_counter()
+    for num in range(frames):
         burn(fluid)
+        step(fluid, solver, dt)
+        out[num] = pack_frame(fluid, fields, out.dtype)
+    out.flush()
+    elapsed = time.perf_counter() - tic
 
-        # Velocity step
-        fluid.swap_velocity()
-        diffuse(BND_VERTICAL, fluid.vel_x, fluid.vel_x0, fluid.viscosity, dt)
-        diffuse(BND_HORIZONTAL, fluid.vel_y, fluid.vel_y0, fluid.viscosity, dt)
+    print('Recorded %d frames (%dx%d, %s) to %s in %.2f sec' % (frames, width, height, dtype, path, elapsed))
 
-        project(fluid.vel_x, fluid.vel_y, fluid.vel_x0, fluid.vel_y0)
 
-        fluid.swap_velocity()
-        advect(BND_VERTICAL, fluid.vel_x, fluid.vel_x0, fluid.vel_x0, fluid.vel_y0, dt)
-        advect(BND_HORIZONTAL, fluid.vel_y, fluid.vel_y0, fluid.vel_x0, fluid.vel_y0, dt)
+def pack_frame(fluid, fields, dtype):
+    """Fluid state as single frame."""
+    frame = np.stack([fluid.density, fluid.vel_x, fluid.vel_y][:fields])
+    if dtype != np.uint8:
+        return frame.astype(dtype)
 
-        project(fluid.vel_x, fluid.vel_y, fluid.vel_x0, fluid.vel_y0)
+    frame[0] *= RECORD_DENSITY_SCALE
+    frame[1:] = (frame[1:] / RECORD_VELOCITY_RANGE + 1) * 127.5
+    return np.clip(frame, 0, 255).astype(np.uint8)
 
-        # Density step
 
-        # We try to find the densities which, when diffused backward in time,
-        # gives the density we started with.
-        # For each grid cell of the latter we trace the cell’s center
-        # position backwards through the velocity field.
-        fluid.swap_density()
-        diffuse(BND_NONE, fluid.density, fluid.density0, fluid.diffusion, dt)
-        fluid.swap_density()
-        advect(BND_NONE, fluid.density, fluid.density0, fluid.vel_x, fluid.vel_y, dt)
+def unpack_frame(fluid, frame):
+    """Restore fluid state from frame."""
+    quantized = frame.dtype == np.uint8
+    frame = frame.astype(float)
 
-        render_fluid_with_blocks(screen, fluid)
-        # render_fluid_with_chars(screen, fluid)
+    if quantized:
+        # Middle of quantization step, so int(density * scale) gives stored value
+        frame[0] = (frame[0] + 0.5) / RECORD_DENSITY_SCALE
+        frame[1:] = (frame[1:] / 127.5 - 1) * RECORD_VELOCITY_RANGE
 
-        # Sleep only if extra time left
-        delay = max(0, dt - (time.time() - tic))
-        time.sleep(delay)
+    fluid.density = frame[0]
+    if len(frame) > 1:
+        fluid.vel_x, fluid.vel_y = frame[1], frame[2]
 
-        screen.refresh()
 
-    screen.endwin()
+def replay(path, fps, ansi):
+    """
+    Play recorded frames. Frames are streamed from file, not loaded at once.
+    Recording bigger than terminal is cropped to its bottom middle part, where
+    the burner is.
+    """
+    frames = np.load(path, mmap_mode='r')
+    _, _, height, width = frames.shape
+
+    screen_class = AnsiScreen if ansi else Screen
+    screen = screen_class(colormap=cm.viridis, mode='matplotlib')
+
+    try:
+        # Same layout as in main() - borders take two columns and two lines,
+        # last column is left empty
+        crop_width = max(0, min(width - 2, screen.COLS - 3))
+        crop_height = max(0, min(height - 2, 2 * (screen.LINES - 2)))
+        x0 = 1 + (width - 2 - crop_width) // 2
+        y0 = height - 1 - crop_height
+        # Cropped frames keep one cell layer around as boundary
+        crop = (slice(None), slice(y0 - 1, y0 + crop_height + 1), slice(x0 - 1, x0 + crop_width + 1))
+        fluid = Fluid(diffusion=0, viscosity=0, width=crop_width+2, height=crop_height+2)
+
+        render_aquarium_borders(screen, fluid)
+        pairs = None
+
+        for frame in frames:
+            tic = time.time()
+
+            unpack_frame(fluid, frame[crop])
+            pairs = render_fluid_with_blocks(screen, fluid, pairs)
+
+            delay = max(0, 1/fps - (time.time() - tic))
+            time.sleep(delay)
+
+            screen.refresh()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        screen.endwin()
+
+
+def compare_solvers(steps, dt, width, height):
+    """
+    Run the same seeded simulation on every solver backend. Report time per
+    step and max deviation of fields from the reference backend.
+    """
+    fields = ('density', 'vel_x', 'vel_y')
+    reference = None
+
+    print('%-10s %10s %12s %12s %12s' % (('solver', 'ms/step') + fields))
+    for name in ['reference'] + sorted(set(SOLVERS) - {'reference'}):
+        random.seed(81227)
+        fluid = create_fluid(width, height)
+        solver = SOLVERS[name]()
+
+        elapsed = 0
+        deviation = dict.fromkeys(fields, 0.0)
+        snapshots = []
+        for num in range(steps):
+            burn(fluid)
+
+            tic = time.perf_counter()
+            step(fluid, solver, dt)
+            elapsed += time.perf_counter() - tic
+
+            snapshot = [getattr(fluid, f).copy() for f in fields]
+            if reference is None:
+                snapshots.append(snapshot)
+                continue
+
+            for field, arr, ref_arr in zip(fields, snapshot, reference[num]):
+                deviation[field] = max(deviation[field], np.max(np.abs(arr - ref_arr)))
+
+        if reference is None:
+            reference = snapshots
+
+        print('%-10s %10.3f %12.6g %12.6g %12.6g' % ((name, 1000 * elapsed / steps) +
+                                                    tuple(deviation[f] for f in fields)))
 
 
 def burn(fluid):
     for _ in range(10):
-        y = random.randint(1, GRID_SIZE-2)
-        if y > GRID_SIZE//2:
-            x = random.randint(GRID_SIZE//2 - 5, GRID_SIZE//2 + 5)
+        y = random.randint(1, fluid.height-2)
+        if y > fluid.height//2:
+            x = random.randint(max(1, fluid.width//2 - JET_HALF_WIDTH),
+                               min(fluid.width - 2, fluid.width//2 + JET_HALF_WIDTH))
             vel_x = random.uniform(-5, 5)
             vel_y = random.uniform(-3, -4)
         else:
-            x = random.randint(1, GRID_SIZE-2)
+            x = random.randint(1, fluid.width-2)
             vel_x = random.uniform(-2, 9)
             vel_y = random.uniform(-4, 2)
         fluid.add_velocity(x, y, vel_x, vel_y)
 
-    fluid.add_density(x=GRID_SIZE//2, y=GRID_SIZE-2, amount=random.randint(5, 18))
+    fluid.add_density(x=fluid.width//2, y=fluid.height-2, amount=random.randint(5, 18))
 
 
 def plog(*args, **kwargs):
@@ -142,6 +448,7 @@ class Screen:
 
     def _setup_ncurses(self):
         """Setup ncurses screen."""
+        self.LINES, self.COLS = terminal_size()
         self._win = self._ncurses.initscr()
         self._ncurses.start_color()
         self._ncurses.halfdelay(5)
@@ -172,7 +479,7 @@ class Screen:
                 plog('init_extended_color error: %d, for color_num: %d' % (ret, color_num))
                 raise RuntimeError
 
-        self._init_color_pairs()
+        self._pairs = ColorPairs(self._ncurses)
 
     def _init_matplotlib_colors(self, colormap):
         """Initialize color based on matplotlib colormap."""
@@ -185,23 +492,7 @@ class Screen:
                 plog('init_extended_color error: %d, for color_num: %d' % (ret, color_num))
                 raise RuntimeError
 
-        self._init_color_pairs()
-
-    def _init_color_pairs(self):
-        """Initialize color pairs."""
-        for bg, fg in it.product(range(NUM_OF_COLORS), range(NUM_OF_COLORS)):
-            # Start from 1 (0 is reserved by ncurses)
-            pair_num = self.colors_to_pair_num(fg, bg)
-
-            # Pair number 0 is reserved by lib, and can't be initialized
-            if pair_num == 0:
-                continue
-
-            ret = self._ncurses.init_extended_pair(pair_num, fg, bg)
-            if ret != 0:
-                plog('init_extended_pair error: %d, for pair_num: %d' % (ret, pair_num))
-                raise RuntimeError
-
+        self._pairs = ColorPairs(self._ncurses)
 
     def _init_text_colors(self):
         """Reserver two color for text."""
@@ -231,8 +522,14 @@ class Screen:
     def addstr(self, y, x, text, pair_num=0):
         """
         addstr - similar to curses.addstr function, however pair_num shouldn't
-        be converted by curses.color_pair or similar.
+        be converted by curses.color_pair or similar. Pair number is logical
+        one (see colors_to_pair_num).
         """
+        if pair_num != 0:
+            # Pair is registered in ncurses on first use
+            bg, fg = divmod(pair_num - 1, NUM_OF_COLORS)
+            pair_num = self._pairs.get(fg, bg)
+
         pair_num_short = ct.cast((ct.c_int*1)(pair_num), ct.POINTER(ct.c_short)).contents
         pair_num_pt = ct.c_int(pair_num)
         ret = self._ncurses.attr_set(ct.c_int(self.A_NORMAL), pair_num_short, ct.pointer(pair_num_pt))
@@ -252,6 +549,14 @@ class Screen:
             pair_num = 1
         return pair_num
 
+    @property
+    def pair_evictions(self):
+        """
+        Number of pairs redefined so far. When it changes, cells printed in
+        previous frames could change their colors.
+        """
+        return self._pairs.evictions
+
     def refresh(self):
         """Refresh screen."""
         self._ncurses.refresh()
@@ -262,19 +567,160 @@ class Screen:
         plog('The end.')
 
 
+class AnsiScreen:
+    """
+    Screen backend without ncurses. Each cell gets exact 24-bit ("true color")
+    colors from colormap, so there is no color pairs limit. Frame is kept in
+    buffer and on refresh all changed lines are written with single os.write,
+    color codes are emitted only when colors change.
+    """
+    ESC = '\x1b['
+
+    # Color numbers reserved for text (see Screen._init_text_colors)
+    TEXT_FG = NUM_OF_COLORS
+    TEXT_BG = NUM_OF_COLORS + 1
+
+    # There are no ncurses pairs to redefine
+    pair_evictions = 0
+
+    def __init__(self, colormap, mode='matplotlib'):
+        if mode == 'matplotlib':
+            colors = [colormap.colors[color_num][:3] for color_num in range(NUM_OF_COLORS)]
+        elif mode == 'green':
+            colors = [(0, color_num/NUM_OF_COLORS, 0) for color_num in range(NUM_OF_COLORS)]
+        else:
+            raise Exception('Unknown mode: ', mode)
+        colors += [(0.6, 0.6, 0.6), (0, 0, 0)]
+
+        rgb = (np.array(colors) * 255).round().astype(int)
+        self._fg_codes = [self.ESC + '38;2;%d;%d;%dm' % tuple(c) for c in rgb]
+        self._bg_codes = [self.ESC + '48;2;%d;%d;%dm' % tuple(c) for c in rgb]
+
+        self.LINES, self.COLS = terminal_size()
+        self._chars = [[' '] * self.COLS for _ in range(self.LINES)]
+        self._colors = [[(self.TEXT_FG, self.TEXT_BG)] * self.COLS for _ in range(self.LINES)]
+        self._dirty_lines = set(range(self.LINES))
+
+        self._fd = sys.stdout.fileno()
+        self._tty_attr = None
+        if os.isatty(self._fd):
+            self._tty_attr = termios.tcgetattr(self._fd)
+            tty.setcbreak(self._fd)
+
+        # Alternate screen buffer, hide cursor
+        self._write(self.ESC + '?1049h' + self.ESC + '?25l')
+
+    def addstr(self, y, x, text, pair_num=0):
+        """Similar to Screen.addstr, but only update frame buffer."""
+        if pair_num == 0:
+            colors = (self.TEXT_FG, self.TEXT_BG)
+        else:
+            bg, fg = divmod(pair_num - 1, NUM_OF_COLORS)
+            colors = (fg, bg)
+
+        end = min(x + len(text), self.COLS)
+        if y >= self.LINES or x >= end:
+            return
+
+        self._chars[y][x:end] = text[:end - x]
+        self._colors[y][x:end] = [colors] * (end - x)
+        self._dirty_lines.add(y)
+
+    def colors_to_pair_num(self, foreground, background):
+        """Determine pair number for two colors."""
+        pair_num = int(background) * NUM_OF_COLORS + int(foreground) + 1
+        if pair_num == 0:
+            pair_num = 1
+        return pair_num
+
+    def refresh(self):
+        """Write all changed lines to terminal."""
+        buf = []
+        for y in sorted(self._dirty_lines):
+            buf.append(self.ESC + '%d;1H' % (y + 1))
+
+            fg, bg = None, None
+            for char, (cell_fg, cell_bg) in zip(self._chars[y], self._colors[y]):
+                if cell_fg != fg:
+                    fg = cell_fg
+                    buf.append(self._fg_codes[fg])
+                if cell_bg != bg:
+                    bg = cell_bg
+                    buf.append(self._bg_codes[bg])
+                buf.append(char)
+
+        self._dirty_lines.clear()
+        self._write(''.join(buf))
+
+    def _write(self, text):
+        """Write whole text to terminal."""
+        data = text.encode('utf-8')
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+
+    def endwin(self):
+        """Restore terminal."""
+        self._write(self.ESC + '0m' + self.ESC + '?25h' + self.ESC + '?1049l')
+        if self._tty_attr:
+            termios.tcsetattr(self._fd, termios.TCSADRAIN, self._tty_attr)
+        plog('The end.')
+
+
+class ColorPairs:
+    """
+    Color pairs registered in ncurses on first use. There are only COLOR_PAIRS
+    pairs available, so when limit is reached least recently used pair is
+    redefined.
+    """
+
+    def __init__(self, ncurses):
+        self._ncurses = ncurses
+        # Pair number 0 is reserved by lib, and can't be initialized
+        self.limit = ct.c_int.in_dll(ncurses, 'COLOR_PAIRS').value - 1
+        self.evictions = 0
+        self._pairs = co.OrderedDict()  # (fg, bg) -> pair_num
+
+    def get(self, fg, bg):
+        """Pair number for two colors."""
+        key = (fg, bg)
+        pair_num = self._pairs.get(key)
+        if pair_num is not None:
+            self._pairs.move_to_end(key)
+            return pair_num
+
+        if len(self._pairs) < self.limit:
+            pair_num = len(self._pairs) + 1
+        else:
+            _, pair_num = self._pairs.popitem(last=False)
+            self.evictions += 1
+
+        ret = self._ncurses.init_extended_pair(pair_num, fg, bg)
+        if ret != 0:
+            plog('init_extended_pair error: %d, for pair_num: %d' % (ret, pair_num))
+            raise RuntimeError
+
+        self._pairs[key] = pair_num
+        return pair_num
+
+
 class Fluid:
-    def __init__(self, diffusion, viscosity):
+    def __init__(self, diffusion, viscosity, width=GRID_SIZE, height=GRID_SIZE):
         self.diffusion = diffusion  # dyfuzja
         self.viscosity = viscosity  # lepkość
 
-        self.density = np.zeros(shape=(GRID_SIZE, GRID_SIZE))
-        self.density0 = np.zeros(shape=(GRID_SIZE, GRID_SIZE))  # previous density
+        # Grid size with boundaries around fluid
+        self.width = width
+        self.height = height
+
+        self.density = np.zeros(shape=(height, width))
+        self.density0 = np.zeros(shape=(height, width))  # previous density
 
-        self.vel_x = np.zeros(shape=(GRID_SIZE, GRID_SIZE))
-        self.vel_x0 = np.zeros(shape=(GRID_SIZE, GRID_SIZE))    # previous velocity
+        self.vel_x = np.zeros(shape=(height, width))
+        self.vel_x0 = np.zeros(shape=(height, width))    # previous velocity
 
-        self.vel_y = np.zeros(shape=(GRID_SIZE, GRID_SIZE))
-        self.vel_y0 = np.zeros(shape=(GRID_SIZE, GRID_SIZE))    # previous velocity
+        self.vel_y = np.zeros(shape=(height, width))
+        self.vel_y0 = np.zeros(shape=(height, width))    # previous velocity
 
     def add_density(self, x, y, amount):
         self.density[y, x] += amount
@@ -291,24 +737,53 @@ class Fluid:
         self.density0, self.density = self.density, self.density0
 
 
-def render_fluid_with_blocks(screen, fluid):
-    """Render fluid."""
-    # Normalize density array
-    norm_dens = fluid.density * 50
+def normalize_density(density, scale):
+    """Map density to color numbers."""
     # Set max possible color
-    norm_dens[norm_dens>=NUM_OF_COLORS] = NUM_OF_COLORS - 1
-    norm_dens = norm_dens.astype(int)
+    return np.clip(density * scale, 0, NUM_OF_COLORS - 1).astype(int)
 
+
+def encode_blocks(field, scale):
+    """
+    Pair numbers of LOWER_HALF_BLOCK cells for whole 2D field (even number of
+    rows). Upper row of cell is background, lower is foreground (same as
+    Screen.colors_to_pair_num).
+    """
+    colors = normalize_density(field, scale)
+    return colors[0::2] * NUM_OF_COLORS + colors[1::2] + 1
+
+
+def encode_chars(field, scale):
+    """
+    Chars and pair numbers for whole 2D field (even number of rows), based on
+    upper row of each cell and golden ratio thresholds (CHAR_THRESHOLDS).
+    """
+    thresholds, chars, fg_scales = zip(*CHAR_THRESHOLDS)
+    colors = normalize_density(field[0::2], scale)
+
+    level = np.searchsorted(thresholds[:-1], colors, side='right')
+    bg = (np.array(fg_scales)[level] * colors / np.array(thresholds)[level]).astype(int)
+    fg = np.where(level == 0, 1, colors)
+
+    return np.array(chars)[level], bg * NUM_OF_COLORS + fg + 1
+
+
+def render_debug_info(screen, fluid, scale):
+    """Render debug info next to aquarium, if there is room for it."""
     y_shift = Y_SHIFT + 1
-    x_shift = GRID_SIZE + X_SHIFT + 1
+    x_shift = fluid.width + X_SHIFT + 1
+
+    if x_shift + INFO_WIDTH > screen.COLS:
+        return
+
+    norm_dens = normalize_density(fluid.density, scale)
 
-    # Print debug info
     bg, fg = norm_dens[1:3, 1]
     pair_num = screen.colors_to_pair_num(fg, bg)
     screen.addstr(0 + y_shift, 0 + x_shift, LOWER_HALF_BLOCK, pair_num)
     screen.addstr(0 + y_shift, 3 + x_shift, 'bg: %d fg: %d pair_num: %d  ' % (bg, fg, pair_num))
 
-    vel = (fluid.vel_y[GRID_SIZE//2][GRID_SIZE//2], fluid.vel_x[GRID_SIZE//2][GRID_SIZE//2])
+    vel = (fluid.vel_y[fluid.height//2][fluid.width//2], fluid.vel_x[fluid.height//2][fluid.width//2])
     screen.addstr(1 + y_shift, 0 + x_shift, 'velocity[y, x]: (%4.2f, %4.2f)  ' % vel)
 
     screen.addstr(2 + y_shift, 0 + x_shift, 'Max     : %6.4f      ' % np.max(fluid.density))
@@ -316,81 +791,83 @@ def render_fluid_with_blocks(screen, fluid):
     screen.addstr(4 + y_shift, 0 + x_shift, 'Min     : %6.4f      ' %  np.min(fluid.density))
     screen.addstr(5 + y_shift, 0 + x_shift, 'Min norm: %d  ' % np.min(norm_dens))
 
+
+def render_fluid_with_blocks(screen, fluid, prev_pairs=None):
+    """
+    Render fluid. Only cells with pair number different than in previous frame
+    (prev_pairs) are printed, and neighbour cells in row with the same pair
+    number are printed at once. Return pair numbers of this frame.
+    """
+    render_debug_info(screen, fluid, scale=50)
+
+    pairs = encode_blocks(fluid.density[1:-1, 1:-1], 50)
+    if prev_pairs is None or prev_pairs.shape != pairs.shape:
+        changed = np.ones(shape=pairs.shape, dtype=bool)
+    else:
+        changed = pairs != prev_pairs
+
     # Print fluid
+    y_shift = Y_SHIFT + 1
     x_shift = X_SHIFT + 1
 
-    for i in range(1, GRID_SIZE-1):
-        for j in range(1, GRID_SIZE-1, 2):
-            bg, fg = norm_dens[j:j+2, i]
-            pair_num = screen.colors_to_pair_num(fg, bg)
-            screen.addstr(j//2 + y_shift, (i - 1) + x_shift, LOWER_HALF_BLOCK, pair_num)
+    evictions = screen.pair_evictions
+    for y, x, length, pair_num in changed_runs(pairs, changed):
+        screen.addstr(y + y_shift, x + x_shift, LOWER_HALF_BLOCK * length, pair_num)
 
+    # Pair used by unchanged cell could be redefined, so repaint everything
+    if screen.pair_evictions != evictions:
+        for y, x, length, pair_num in changed_runs(pairs, np.ones(shape=pairs.shape, dtype=bool)):
+            screen.addstr(y + y_shift, x + x_shift, LOWER_HALF_BLOCK * length, pair_num)
 
-def render_fluid_with_chars(screen, fluid):
-    """Render fluid using chars."""
-    # Normalize density array
-    norm_dens = fluid.density * 40
-    # Set max possible color
-    norm_dens[norm_dens>=NUM_OF_COLORS] = NUM_OF_COLORS - 1
-    norm_dens = norm_dens.astype(int)
+    return pairs
 
-    y_shift = Y_SHIFT + 1
-    x_shift = GRID_SIZE + X_SHIFT + 1
 
-    # Print debug info
-    bg, fg = norm_dens[1:3, 1]
-    pair_num = screen.colors_to_pair_num(fg, bg)
-    screen.addstr(0 + y_shift, 0 + x_shift, LOWER_HALF_BLOCK, pair_num)
-    screen.addstr(0 + y_shift, 3 + x_shift, 'bg: %d fg: %d pair_num: %d  ' % (bg, fg, pair_num))
+def changed_runs(pairs, changed):
+    """
+    Split changed cells into runs - (y, x, length, pair_num) of neighbour cells
+    in the same row with the same pair number.
+    """
+    idx = np.flatnonzero(changed)
+    if not idx.size:
+        return []
 
-    vel = (fluid.vel_y[GRID_SIZE//2][GRID_SIZE//2], fluid.vel_x[GRID_SIZE//2][GRID_SIZE//2])
-    screen.addstr(1 + y_shift, 0 + x_shift, 'velocity[y, x]: (%4.2f, %4.2f)  ' % vel)
+    width = pairs.shape[1]
+    values = pairs.ravel()[idx]
 
-    screen.addstr(2 + y_shift, 0 + x_shift, 'Max     : %6.4f      ' % np.max(fluid.density))
-    screen.addstr(3 + y_shift, 0 + x_shift, 'Max norm: %d  ' % np.max(norm_dens))
-    screen.addstr(4 + y_shift, 0 + x_shift, 'Min     : %6.4f      ' %  np.min(fluid.density))
-    screen.addstr(5 + y_shift, 0 + x_shift, 'Min norm: %d  ' % np.min(norm_dens))
+    # New run starts when cells aren't adjacent, row changes or pair changes
+    starts = np.ones(shape=idx.shape, dtype=bool)
+    starts[1:] = (np.diff(idx) != 1) | (idx[1:] % width == 0) | (values[1:] != values[:-1])
+
+    first = np.flatnonzero(starts)
+    lengths = np.diff(np.append(first, idx.size))
+
+    return zip((idx[first] // width).tolist(), (idx[first] % width).tolist(),
+               lengths.tolist(), values[first].tolist())
+
+
+def render_fluid_with_chars(screen, fluid):
+    """Render fluid using chars."""
+    render_debug_info(screen, fluid, scale=40)
+
+    chars, pairs = encode_chars(fluid.density[1:-1, 1:-1], 40)
 
     # Print fluid
+    y_shift = Y_SHIFT + 1
     x_shift = X_SHIFT + 1
 
-    for i in range(1, GRID_SIZE-1):
-        for j in range(1, GRID_SIZE-1, 2):
-            bg, _ = norm_dens[j:j+2, i]
-
-            # Golden ratio thresholds
-            if bg < 97:
-                pair_num = screen.colors_to_pair_num(1, 12 * bg/97)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, ' ', pair_num)
-            elif bg < 158:
-                pair_num = screen.colors_to_pair_num(bg, 24 * bg/158)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, '.', pair_num)
-            elif bg < 195:
-                pair_num = screen.colors_to_pair_num(bg, 36 * bg/195)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, '-', pair_num)
-            elif bg < 218:
-                pair_num = screen.colors_to_pair_num(bg, 48 * bg/218)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, 'o', pair_num)
-            elif bg < 232:
-                pair_num = screen.colors_to_pair_num(bg, 60 * bg/232)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, 'X', pair_num)
-            elif bg < 241:
-                pair_num = screen.colors_to_pair_num(bg, 72 * bg/241)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, '%', pair_num)
-            else:
-                pair_num = screen.colors_to_pair_num(bg, 84 * bg/256)
-                screen.addstr(j//2 + y_shift, (i - 1) + x_shift, '@', pair_num)
-
-
-def render_aquarium_borders(screen):
+    for y, x, length, pair_num in changed_runs(pairs, np.ones(shape=pairs.shape, dtype=bool)):
+        screen.addstr(y + y_shift, x + x_shift, ''.join(chars[y, x:x+length]), pair_num)
+
+
+def render_aquarium_borders(screen, fluid):
     """Render aquarium borders."""
-    vertical_border = '+' + '-' * (GRID_SIZE-2) + '+'
+    vertical_border = '+' + '-' * (fluid.width-2) + '+'
     screen.addstr(0 + Y_SHIFT, 0 + X_SHIFT, vertical_border)
-    screen.addstr((GRID_SIZE-2)//2 + 1 + Y_SHIFT, 0 + X_SHIFT, vertical_border)
+    screen.addstr((fluid.height-2)//2 + 1 + Y_SHIFT, 0 + X_SHIFT, vertical_border)
 
-    for y in range((GRID_SIZE-2)//2):
+    for y in range((fluid.height-2)//2):
         screen.addstr(y + 1 + Y_SHIFT, 0 + X_SHIFT, '|')
-        screen.addstr(y + 1 + Y_SHIFT, (GRID_SIZE - 2) + 1 + X_SHIFT, '|')
+        screen.addstr(y + 1 + Y_SHIFT, (fluid.width - 2) + 1 + X_SHIFT, '|')
 
 
 def diffuse(boundary, x, x0, diffusion, dt):
@@ -398,7 +875,8 @@ def diffuse(boundary, x, x0, diffusion, dt):
     Diffusion is the net movement of anything (for example dye) from
     a region of higher concentration to a region of lower concentration.
     """
-    a = dt * diffusion * (GRID_SIZE - 2) * (GRID_SIZE - 2)
+    n = grid_scale(x)
+    a = dt * diffusion * n * n
     linear_solver(boundary, x, x0, a, 1 + 4 * a)
 
 
@@ -407,9 +885,10 @@ def linear_solver(boundary, x, x0, a, c):
     Solving a system of linear differential equation using Gauss-Seidel
     relaxation.
     """
+    height, width = x.shape
     for _ in range(SOLVER_ITERATIONS):
-        for j in range(1, GRID_SIZE - 1):
-            for i in range(1, GRID_SIZE - 1):
+        for j in range(1, height - 1):
+            for i in range(1, width - 1):
                 x[j, i] = (x0[j, i] + a*(x[j, i+1] + x[j, i-1] + x[j+1, i] + x[j-1, i])) / c
 
     set_boundary(boundary, x)
@@ -423,9 +902,10 @@ def project(vel_x, vel_y, p, div):
     in each cell has to stay constant. Amount of fluid going in has must be
     equal to the amount of fluid going out of cell.
     """
-    cell_size = 1 / (GRID_SIZE - 2)
-    for j in range(1, GRID_SIZE - 1):
-        for i in range(1, GRID_SIZE - 1):
+    height, width = vel_x.shape
+    cell_size = 1 / grid_scale(vel_x)
+    for j in range(1, height - 1):
+        for i in range(1, width - 1):
             div[j, i] = -0.5 * cell_size * (vel_x[j, i+1] - vel_x[j, i-1] + vel_y[j+1, i] - vel_y[j-1, i])
             p[j, i] = 0
 
@@ -433,8 +913,8 @@ def project(vel_x, vel_y, p, div):
     set_boundary(BND_NONE, p)
     linear_solver(0, p, div, 1, 4)
 
-    for j in range(1, GRID_SIZE - 1):
-        for i in range(1, GRID_SIZE - 1):
+    for j in range(1, height - 1):
+        for i in range(1, width - 1):
             vel_x[j, i] -= 0.5 * (p[j, i+1] - p[j, i-1]) / cell_size
             vel_y[j, i] -= 0.5 * (p[j+1, i] - p[j-1, i]) / cell_size
 
@@ -447,24 +927,25 @@ def advect(boundary, d, d0, vel_x, vel_y, dt):
     Advection is the transport of a substance or quantity by fluid in this way
     that velocity of transported substance is equal to velocity of fluid.
     """
-    dt0 = dt * (GRID_SIZE - 2)
+    height, width = d.shape
+    dt0 = dt * grid_scale(d)
 
-    for j in range(1, GRID_SIZE - 1):
-        for i in range(1, GRID_SIZE - 1):
+    for j in range(1, height - 1):
+        for i in range(1, width - 1):
             x = i - dt0 * vel_x[j, i]
             y = j - dt0 * vel_y[j, i]
 
             if x < 0.5:
                 x = 0.5
-            elif x > (GRID_SIZE - 2) + 0.5:
-                x = (GRID_SIZE - 2) + 0.5
+            elif x > (width - 2) + 0.5:
+                x = (width - 2) + 0.5
             i0 = int(x)
             i1 = i0 + 1
 
             if y < 0.5:
                 y = 0.5
-            elif y > (GRID_SIZE - 2) + 0.5:
-                y = (GRID_SIZE - 2) + 0.5
+            elif y > (height - 2) + 0.5:
+                y = (height - 2) + 0.5
             j0 = int(y)
             j1 = j0 + 1
 
@@ -484,31 +965,317 @@ def set_boundary(boundary, matrix):
     Keep fluid from leaking out of the box. Every velocity in the layer next to
     this outer layer is mirrored.
     """
-    for i in range(1, GRID_SIZE-1):
+    height, width = matrix.shape
+    for i in range(1, width-1):
         # Copy and mirror value from border - protection against leaking
         if boundary == BND_HORIZONTAL:
             matrix[0, i]           = -matrix[1, i]
-            matrix[GRID_SIZE-1, i] = -matrix[GRID_SIZE-2, i]
+            matrix[height-1, i] = -matrix[height-2, i]
         # Copy from border
         else:
             matrix[0, i]           = matrix[1, i]
-            matrix[GRID_SIZE-1, i] = matrix[GRID_SIZE-2, i]
+            matrix[height-1, i] = matrix[height-2, i]
 
-    for j in range(1, GRID_SIZE-1):
+    for j in range(1, height-1):
         # Copy and mirror value from border - protection against leaking
         if boundary == BND_VERTICAL:
             matrix[j, 0]           = -matrix[j, 1]
-            matrix[j, GRID_SIZE-1] = -matrix[j, GRID_SIZE-2]
+            matrix[j, width-1] = -matrix[j, width-2]
         # Copy from border
         else:
             matrix[j, 0]           = matrix[j, 1]
-            matrix[j, GRID_SIZE-1] = matrix[j, GRID_SIZE-2]
+            matrix[j, width-1] = matrix[j, width-2]
 
     # Corners
-    matrix[0, 0]                     = 0.5 * (matrix[0, 1] + matrix[1, 0])
-    matrix[GRID_SIZE-1, 0]           = 0.5 * (matrix[GRID_SIZE-1, 1] + matrix[GRID_SIZE-2, 0])
-    matrix[0, GRID_SIZE-1]           = 0.5 * (matrix[0, GRID_SIZE-2] + matrix[1, GRID_SIZE-1])
-    matrix[GRID_SIZE-1, GRID_SIZE-1] = 0.5 * (matrix[GRID_SIZE-1, GRID_SIZE-2] + matrix[GRID_SIZE-2, GRID_SIZE-1])
+    matrix[0, 0]                  = 0.5 * (matrix[0, 1] + matrix[1, 0])
+    matrix[height-1, 0]           = 0.5 * (matrix[height-1, 1] + matrix[height-2, 0])
+    matrix[0, width-1]            = 0.5 * (matrix[0, width-2] + matrix[1, width-1])
+    matrix[height-1, width-1]     = 0.5 * (matrix[height-1, width-2] + matrix[height-2, width-1])
+
+
+
+def grid_scale(matrix):
+    """
+    Number of fluid cells along longer side of the grid. Cells are square, so
+    cell size is 1/grid_scale.
+    """
+    return max(matrix.shape) - 2
+
+class Solver:
+    """
+    Solver backend interface. Backend operates on Fluid arrays passed by step()
+    and must give the same results as ReferenceSolver (see --compare).
+    """
+
+    def diffuse(self, boundary, x, x0, diffusion, dt):
+        raise NotImplementedError
+
+    def project(self, vel_x, vel_y, p, div):
+        raise NotImplementedError
+
+    def advect(self, boundary, d, d0, vel_x, vel_y, dt):
+        raise NotImplementedError
+
+    def set_boundary(self, boundary, matrix):
+        raise NotImplementedError
+
+
+class ReferenceSolver(Solver):
+    """Reference backend - plain Python loops from the original paper."""
+
+    def diffuse(self, boundary, x, x0, diffusion, dt):
+        diffuse(boundary, x, x0, diffusion, dt)
+
+    def project(self, vel_x, vel_y, p, div):
+        project(vel_x, vel_y, p, div)
+
+    def advect(self, boundary, d, d0, vel_x, vel_y, dt):
+        advect(boundary, d, d0, vel_x, vel_y, dt)
+
+    def set_boundary(self, boundary, matrix):
+        set_boundary(boundary, matrix)
+
+
+class NumpySolver(Solver):
+    """
+    Solver backend built from whole-array NumPy expressions. Works on the same
+    Fluid arrays as diffuse/project/advect free functions.
+    """
+
+    def __init__(self, iterations=SOLVER_ITERATIONS):
+        self.iterations = iterations
+        self._grids = {}
+
+    def diffuse(self, boundary, x, x0, diffusion, dt):
+        """Diffusion step (see diffuse)."""
+        n = grid_scale(x)
+        a = dt * diffusion * n * n
+        self.linear_solver(boundary, x, x0, a, 1 + 4 * a)
+
+    def linear_solver(self, boundary, x, x0, a, c):
+        """
+        Red-black Gauss-Seidel relaxation. Cells of one color depend only on
+        cells of the other color, so each half sweep is a single slice update.
+        """
+        for _ in range(self.iterations):
+            # Red cells: (j + i) even
+            self._relax(x, x0, a, c, 1, 1)
+            self._relax(x, x0, a, c, 2, 2)
+            # Black cells: (j + i) odd
+            self._relax(x, x0, a, c, 1, 2)
+            self._relax(x, x0, a, c, 2, 1)
+
+        self.set_boundary(boundary, x)
+
+    def _relax(self, x, x0, a, c, jo, io):
+        """Update every second interior cell, starting from (jo, io)."""
+        h, w = x.shape
+        x[jo:h-1:2, io:w-1:2] = (x0[jo:h-1:2, io:w-1:2] +
+                                 a*(x[jo:h-1:2, io+1:w:2] + x[jo:h-1:2, io-1:w-2:2] +
+                                    x[jo+1:h:2, io:w-1:2] + x[jo-1:h-2:2, io:w-1:2])) / c
+
+    def project(self, vel_x, vel_y, p, div):
+        """Mass conserving step (see project)."""
+        cell_size = 1 / grid_scale(vel_x)
+
+        div[1:-1, 1:-1] = -0.5 * cell_size * (vel_x[1:-1, 2:] - vel_x[1:-1, :-2] +
+                                              vel_y[2:, 1:-1] - vel_y[:-2, 1:-1])
+        p[1:-1, 1:-1] = 0
+
+        self.set_boundary(BND_NONE, div)
+        self.set_boundary(BND_NONE, p)
+        self.solve_pressure(p, div)
+
+        vel_x[1:-1, 1:-1] -= 0.5 * (p[1:-1, 2:] - p[1:-1, :-2]) / cell_size
+        vel_y[1:-1, 1:-1] -= 0.5 * (p[2:, 1:-1] - p[:-2, 1:-1]) / cell_size
+
+        self.set_boundary(BND_VERTICAL, vel_x)
+        self.set_boundary(BND_HORIZONTAL, vel_y)
+
+    def solve_pressure(self, p, div):
+        """Solve Poisson equation for pressure."""
+        self.linear_solver(BND_NONE, p, div, 1, 4)
+
+    def advect(self, boundary, d, d0, vel_x, vel_y, dt):
+        """Semi-Lagrangian advection with bilinear gather (see advect)."""
+        height, width = d.shape
+        dt0 = dt * grid_scale(d)
+        jj, ii = self._grid(d.shape)
+
+        x = np.clip(ii - dt0 * vel_x[1:-1, 1:-1], 0.5, (width - 2) + 0.5)
+        y = np.clip(jj - dt0 * vel_y[1:-1, 1:-1], 0.5, (height - 2) + 0.5)
+
+        i0 = x.astype(int)
+        i1 = i0 + 1
+        j0 = y.astype(int)
+        j1 = j0 + 1
+
+        s1 = x - i0
+        s0 = 1 - s1
+        t1 = y - j0
+        t0 = 1 - t1
+
+        d[1:-1, 1:-1] = s0 * (t0 * d0[j0, i0] + t1 * d0[j1, i0]) + \
+                        s1 * (t0 * d0[j0, i1] + t1 * d0[j1, i1])
+
+        self.set_boundary(boundary, d)
+
+    def _grid(self, shape):
+        """Cached interior cell coordinates for given array shape."""
+        if shape not in self._grids:
+            jj, ii = np.mgrid[1:shape[0]-1, 1:shape[1]-1]
+            self._grids[shape] = (jj.astype(float), ii.astype(float))
+        return self._grids[shape]
+
+    def set_boundary(self, boundary, matrix):
+        """Mirror values on the outer layer (see set_boundary)."""
+        if boundary == BND_HORIZONTAL:
+            matrix[0, 1:-1] = -matrix[1, 1:-1]
+            matrix[-1, 1:-1] = -matrix[-2, 1:-1]
+        else:
+            matrix[0, 1:-1] = matrix[1, 1:-1]
+            matrix[-1, 1:-1] = matrix[-2, 1:-1]
+
+        if boundary == BND_VERTICAL:
+            matrix[1:-1, 0] = -matrix[1:-1, 1]
+            matrix[1:-1, -1] = -matrix[1:-1, -2]
+        else:
+            matrix[1:-1, 0] = matrix[1:-1, 1]
+            matrix[1:-1, -1] = matrix[1:-1, -2]
+
+        # Corners
+        matrix[0, 0] = 0.5 * (matrix[0, 1] + matrix[1, 0])
+        matrix[-1, 0] = 0.5 * (matrix[-1, 1] + matrix[-2, 0])
+        matrix[0, -1] = 0.5 * (matrix[0, -2] + matrix[1, -1])
+        matrix[-1, -1] = 0.5 * (matrix[-1, -2] + matrix[-2, -1])
+
+
+class MultigridSolver(NumpySolver):
+    """
+    NumPy backend with geometric multigrid (V-cycle) pressure solver. Grid is
+    coarsened by 2 down to a few cells, coarsest level is solved with conjugate
+    gradient. V-cycles are repeated until residual drops below
+    tolerance, so incompressibility doesn't degrade with grid size.
+
+    https://en.wikipedia.org/wiki/Multigrid_method
+    """
+
+    def __init__(self, iterations=SOLVER_ITERATIONS, tolerance=MG_TOLERANCE,
+                 max_cycles=MG_MAX_CYCLES, smooth_steps=MG_SMOOTH_STEPS):
+        super().__init__(iterations)
+        self.tolerance = tolerance
+        self.max_cycles = max_cycles
+        self.smooth_steps = smooth_steps
+
+        # Stats from last pressure solve
+        self.cycles = 0
+        self.residual = 0
+        # Totals over all pressure solves
+        self.solves = 0
+        self.total_cycles = 0
+        self.limit_hits = 0
+
+    def solve_pressure(self, p, div):
+        """Repeat V-cycles until residual is small enough."""
+        norm = np.max(np.abs(div[1:-1, 1:-1]))
+        self.cycles = 0
+        self.residual = 0
+        if norm == 0:
+            return
+
+        # Pure Neumann problem is solvable only for zero-mean right hand side
+        div = div.copy()
+        div[1:-1, 1:-1] -= div[1:-1, 1:-1].mean()
+
+        while self.cycles < self.max_cycles:
+            self._v_cycle(p, div)
+            self.cycles += 1
+
+            # Neumann problem - constant part of residual can't be removed
+            r = self._residual(p, div)
+            self.residual = np.max(np.abs(r - r.mean())) / norm
+            if self.residual <= self.tolerance:
+                break
+
+        self.solves += 1
+        self.total_cycles += self.cycles
+        if self.residual > self.tolerance:
+            self.limit_hits += 1
+
+    def _v_cycle(self, x, b):
+        """Single V-cycle. Arrays have one cell boundary layer."""
+        self._smooth(x, b)
+
+        h, w = x.shape[0] - 2, x.shape[1] - 2
+        if min(h, w) < 4:
+            self._solve_coarsest(x, b)
+            return
+
+        # Restriction. Operator isn't scaled by cell size, so coarse right hand
+        # side is (2h)^2/h^2 = 4 times average of the fine residual. For odd
+        # size last coarse cell covers only one row/column of fine cells.
+        r = np.pad(self._residual(x, b), ((0, h % 2), (0, w % 2)))
+        coarse_b = np.zeros(shape=((h+1)//2 + 2, (w+1)//2 + 2))
+        coarse_b[1:-1, 1:-1] = r[0::2, 0::2] + r[1::2, 0::2] + r[0::2, 1::2] + r[1::2, 1::2]
+        coarse_x = np.zeros_like(coarse_b)
+
+        self._v_cycle(coarse_x, coarse_b)
+
+        # Prolongation - piecewise constant correction
+        x[1:-1, 1:-1] += coarse_x[1:-1, 1:-1].repeat(2, axis=0).repeat(2, axis=1)[:h, :w]
+        self.set_boundary(BND_NONE, x)
+
+        self._smooth(x, b)
+
+    def _smooth(self, x, b):
+        """Red-black Gauss-Seidel with boundary updated after each half sweep."""
+        for _ in range(self.smooth_steps):
+            self._relax(x, b, 1, 4, 1, 1)
+            self._relax(x, b, 1, 4, 2, 2)
+            self.set_boundary(BND_NONE, x)
+            self._relax(x, b, 1, 4, 1, 2)
+            self._relax(x, b, 1, 4, 2, 1)
+            self.set_boundary(BND_NONE, x)
+
+    def _residual(self, x, b):
+        """Residual b - Ax of interior cells."""
+        return b[1:-1, 1:-1] - (4*x[1:-1, 1:-1] - x[1:-1, 2:] - x[1:-1, :-2] - x[2:, 1:-1] - x[:-2, 1:-1])
+
+    def _solve_coarsest(self, x, b):
+        """Conjugate gradient on the coarsest level."""
+        f = b[1:-1, 1:-1] - b[1:-1, 1:-1].mean()
+        u = x[1:-1, 1:-1].copy()
+
+        r = f - self._apply_operator(u)
+        d = r.copy()
+        rs = np.sum(r * r)
+        limit = (1e-3 * self.tolerance)**2 * np.sum(f * f)
+
+        for _ in range(u.size):
+            if rs <= limit:
+                break
+            ad = self._apply_operator(d)
+            alpha = rs / np.sum(d * ad)
+            u += alpha * d
+            r -= alpha * ad
+            rs_new = np.sum(r * r)
+            d = r + (rs_new / rs) * d
+            rs = rs_new
+
+        x[1:-1, 1:-1] = u
+        self.set_boundary(BND_NONE, x)
+
+    def _apply_operator(self, u):
+        """Poisson operator (4u - neighbors) with Neumann boundary."""
+        up = np.pad(u, 1, mode='edge')
+        return 4*u - up[1:-1, 2:] - up[1:-1, :-2] - up[2:, 1:-1] - up[:-2, 1:-1]
+
+
+SOLVERS = {
+    'reference': ReferenceSolver,
+    'numpy': NumpySolver,
+    'multigrid': MultigridSolver,
+}
 
 
 if __name__ == '__main__':
@@ -11,13 +11,44 @@ import itertools
 import collections as co
 import random
 import time
+import argparse
 import curses
 import locale
+import numpy as np
 
 DEBUG = False
 
 GRAVITY = 1.0
+# Plummer softening length, force of close pairs is finite
+SOFTENING = 1.0
 BLANK_BRAILLE = u'\u2800'
+# Braille dot bit numbers indexed by [x % 2, y % 4] (y grows up, so
+# y % 4 == 0 is bottom row of cell)
+BRAILLE_BITS = np.array([[6, 2, 1, 0],
+                         [7, 5, 4, 3]])
+# Trail length (in seconds) and gray colors (256 colors palette) of trail
+# fading, from the newest dots
+TRAIL_SECONDS = 2
+FADE_COLORS = [255, 250, 245, 240, 236]
+# Max number of body pairs in one chunk of array engine (bounds memory)
+CHUNK_PAIRS = 2**20
+# Barnes-Hut: opening angle, depth of quadtree (bits per axis of Morton
+# code) and number of bodies traversing tree at once
+THETA = 0.5
+MORTON_BITS = 16
+CHUNK_BODIES = 2048
+# World size for headless reports (in braille dots)
+REPORT_WIDTH = 400
+REPORT_HEIGHT = 400
+REPORT_THETAS = [0.3, 0.5, 0.7, 1.0]
+# Adaptive RK45 tolerances and report of integrators (simulated time and
+# frame intervals)
+RK_RTOL = 1e-6
+RK_ATOL = 1e-6
+REPORT_TIME = 10
+REPORT_DTS = [0.04, 0.02, 0.01]
+# Energy in info line is computed only for small clusters (O(N^2))
+ENERGY_MAX_BODIES = 1000
 
 
 class Body:
@@ -56,33 +87,270 @@ class Vector:
         return self/self.mag()
 
 
-def main(scr):
+class Trail:
+    """
+    Braille dots of bodies from last frames. Dots of every frame are kept in
+    ring buffer ((frames, N) array of flat dot indexes, -1 outside screen)
+    and every screen dot has counter of bodies in it. Adding frame removes
+    the oldest one, and only cells where counters changed are recomputed, so
+    frame cost doesn't depend on trail length or simulation time.
+    """
+
+    def __init__(self, shape, count, length):
+        self.shape = shape
+        self.length = length
+        self.frame = 0
+
+        self.codes = np.zeros(shape=shape, dtype=np.uint8)
+        self.dots = np.full(shape=(length, count), fill_value=-1, dtype=np.int32)
+        self.counts = np.zeros(shape=shape[0] * shape[1] * 8, dtype=np.int32)
+        # Frame of the newest dot in cell (for fading)
+        self.last_frame = np.full(shape=shape, fill_value=-length)
+
+    def add(self, points):
+        slot = self.frame % self.length
+        old = self.dots[slot]
+        old = old[old >= 0]
+        self.dots[slot] = point_dots(points, self.shape)
+        new = self.dots[slot]
+        new = new[new >= 0]
+
+        np.subtract.at(self.counts, old, 1)
+        np.add.at(self.counts, new, 1)
+
+        cells = np.unique(np.concatenate([old, new]) // 8)
+        bits = self.counts.reshape(-1, 8)[cells] > 0
+        self.codes.flat[cells] = np.packbits(bits, axis=1, bitorder='little')[:, 0]
+
+        self.last_frame.flat[new // 8] = self.frame
+        self.frame += 1
+
+    def fade_levels(self, levels):
+        """Fade level of every cell, 0 for cells with the newest dots."""
+        age = self.frame - 1 - self.last_frame
+        return np.minimum(age * levels // self.length, levels - 1)
+
+
+class Cluster:
+    """
+    Array version of Body list. Positions and velocities are (N, 2) arrays
+    (x, y columns), masses (N,) array.
+    """
+
+    def __init__(self, bodies):
+        self.pos = np.array([[b.pos.x, b.pos.y] for b in bodies], dtype=float).reshape(-1, 2)
+        self.vel = np.array([[b.vel.x, b.vel.y] for b in bodies], dtype=float).reshape(-1, 2)
+        self.mass = np.array([b.mass for b in bodies], dtype=float)
+
+        # Integrators state: number of force evaluations, acceleration in
+        # current positions (leapfrog and RK45) and step size (RK45)
+        self.force_evals = 0
+        self.acc = None
+        self.step_size = None
+
+
+class QuadTree:
+    """
+    Barnes-Hut quadtree built over arrays, without Node objects. Bodies are
+    sorted by Morton code (bits of x and y interleaved), so every quadtree
+    cell on every level is contiguous range of sorted bodies, and cells of
+    one level are found where code prefix changes. Mass and center of mass
+    of cells are computed by np.add.reduceat. Cells with one body are not
+    split further.
+
+    Nodes of all levels are kept in flat arrays (start/end in sorted bodies,
+    mass, center of mass, size), children of node are consecutive nodes of
+    next level.
+    """
+
+    def __init__(self, pos, mass):
+        self.count = len(pos)
+        self.interactions = 0
+
+        low = pos.min(axis=0) if self.count else np.zeros(2)
+        size = np.max(pos.max(axis=0) - low) if self.count else 0
+        # Slightly bigger, so all bodies are inside
+        size = max(size, 1e-9) * (1 + 1e-9)
+
+        cells = np.minimum(((pos - low) / size * 2**MORTON_BITS).astype(np.int64), 2**MORTON_BITS - 1)
+        codes = spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << np.uint64(1))
+        self.order = np.argsort(codes, kind='stable')
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(self.count)
+
+        codes = codes[self.order]
+        sorted_pos = pos[self.order]
+        sorted_mass = mass[self.order]
+
+        levels = []
+        # Sorted bodies in cells with more than one body
+        active = np.arange(self.count)
+        for level in range(MORTON_BITS + 1):
+            if not active.size:
+                break
+
+            keys = codes[active] >> np.uint64(2 * (MORTON_BITS - level))
+            first = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            count = np.diff(np.append(first, active.size))
+
+            cell_mass = np.add.reduceat(sorted_mass[active], first)
+            moment = np.add.reduceat(sorted_mass[active, np.newaxis] * sorted_pos[active], first, axis=0)
+            com = moment / np.where(cell_mass > 0, cell_mass, 1)[:, np.newaxis]
+
+            start = active[first]
+            levels.append((start, start + count, cell_mass, com, np.full(first.size, size / 2**level)))
+            active = active[np.repeat(count > 1, count)]
+
+        if not levels:
+            levels.append((np.zeros(0, dtype=np.int64),) * 2 + (np.zeros(0), np.zeros((0, 2)), np.zeros(0)))
+
+        self.start, self.end, self.mass, self.com, self.size = (np.concatenate(arrays) for arrays in zip(*levels))
+
+        # Children of node are nodes of next level in its range of bodies
+        self.child_begin = np.zeros_like(self.start)
+        self.child_end = np.zeros_like(self.start)
+        offset = 0
+        for (start, end, *_), next_level in zip(levels, levels[1:] + [None]):
+            if next_level is not None:
+                next_offset = offset + start.size
+                self.child_begin[offset:next_offset] = next_offset + np.searchsorted(next_level[0], start)
+                self.child_end[offset:next_offset] = next_offset + np.searchsorted(next_level[0], end)
+            offset += start.size
+        self.leaf = self.child_begin == self.child_end
+
+    def accelerations(self, pos, theta=THETA):
+        """
+        Acceleration of every body. All bodies of chunk walk tree together,
+        level by level: frontier keeps (body, node) pairs. Node far enough
+        (size/distance < theta) or leaf is approximated by its center of
+        mass, other nodes are replaced in frontier by their children. Node
+        containing body is always opened.
+        """
+        acc = np.zeros_like(pos)
+        if not self.count:
+            return acc
+
+        for begin in range(0, self.count, CHUNK_BODIES):
+            end = min(begin + CHUNK_BODIES, self.count)
+            body = np.arange(begin, end)
+            node = np.zeros_like(body)
+
+            while body.size:
+                diff = self.com[node] - pos[body]
+                dist_squared = np.sum(diff**2, axis=1)
+                rank = self.rank[body]
+                inside = (self.start[node] <= rank) & (rank < self.end[node])
+                accept = self.leaf[node] | (~inside & (self.size[node]**2 < theta**2 * dist_squared))
+                # Leaf with only this body. Leaf on last level can have more
+                # bodies (closer than 1/2**MORTON_BITS of tree size), then
+                # body itself is included in center of mass.
+                use = accept & ~(inside & (self.end[node] - self.start[node] == 1))
+                self.interactions += np.count_nonzero(use)
+
+                weights = self.mass[node[use]] / (dist_squared[use] + SOFTENING**2)**1.5
+                for axis in range(2):
+                    acc[begin:end, axis] += np.bincount(body[use] - begin, weights=weights * diff[use, axis],
+                                                        minlength=end - begin)
+
+                node = node[~accept]
+                counts = self.child_end[node] - self.child_begin[node]
+                body = np.repeat(body[~accept], counts)
+                node = np.repeat(self.child_begin[node] - np.cumsum(counts) + counts, counts) + \
+                    np.arange(counts.sum())
+
+        return GRAVITY * acc
+
+
+def main(scr, args):
     esetup()
     setup_curses()
     scr.clear()
 
-    # bodies = predefined_bodies()
-    bodies = predefined_bodies2()
-    # bodies = rand_bodies()
-    screen_buf = clear_buf()
+    if args.count:
+        bodies = rand_bodies(args.count)
+    else:
+        # bodies = predefined_bodies()
+        bodies = predefined_bodies2()
+    cluster = Cluster(bodies)
+    force = FORCES[args.force]
+    if args.force == 'barnes-hut':
+        force = lambda pos, mass: barnes_hut(pos, mass, args.theta)
+    integrate = INTEGRATORS[args.integrator]
+    energy0 = total_energy(cluster) if len(bodies) <= ENERGY_MAX_BODIES else None
     t = 0
     freq = 100
     dt = 1.0/freq
     step = 0
 
+    codes = clear_codes()
+    trail = None
+    if args.trail:
+        trail = Trail(codes.shape, len(bodies), max(1, round(args.trail * freq)))
+        codes = trail.codes
+    fade = args.fade and trail and setup_fade_colors()
+
     while not check_exit_key(scr, step):
-        calcs(bodies, dt)
+        if args.engine == 'array':
+            integrate(cluster, dt, force)
+            points = cluster.pos
+            info_pos = Vector(*cluster.pos[1 % len(cluster.pos)])
+            info = ' evals: %d' % cluster.force_evals
+            if energy0:
+                info += ' dE: %.2e' % energy_drift(energy0, total_energy(cluster))
+        else:
+            calcs(bodies, dt)
+            points = np.array([[b.pos.x, b.pos.y] for b in bodies])
+            info_pos = bodies[1 % len(bodies)].pos
+            info = ''
 
-        for b in bodies:
-            draw_pt(screen_buf, b.pos)
-        draw_info(screen_buf,  '[%05.2f]: %8.4f %8.4f' % (t, bodies[1].pos.x, bodies[1].pos.y))
-        show(scr, screen_buf)
+        if trail:
+            trail.add(points)
+        else:
+            plot_points(codes, points)
+
+        screen_buf = braille_lines(codes)
+        info = '[%05.2f]: %8.4f %8.4f' % (t, info_pos.x, info_pos.y) + info
+        draw_info(screen_buf, info)
+        if fade:
+            levels = np.where(codes, trail.fade_levels(len(FADE_COLORS)), 0)
+            levels[0, :len(info)] = 0
+            show_faded(scr, screen_buf, levels)
+        else:
+            show(scr, screen_buf)
 
         time.sleep(dt)
         t += dt
         step += 1
 
 
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Orbits in terminal.')
+    parser.add_argument('-e', '--engine', choices=['bodies', 'array'], default='array',
+                        help='Body objects or arrays with all bodies.')
+    parser.add_argument('-n', '--count', type=int, default=0,
+                        help='Number of random bodies (predefined bodies by default).')
+    parser.add_argument('-l', '--trail', type=float, default=TRAIL_SECONDS,
+                        help='Trail length in seconds (0 for whole history).')
+    parser.add_argument('-d', '--fade', action='store_true',
+                        help='Fade trail with age (256 colors terminal).')
+    parser.add_argument('-f', '--force', choices=sorted(FORCES), default='direct',
+                        help='Gravity of array engine: direct sum or Barnes-Hut approximation.')
+    parser.add_argument('-t', '--theta', type=float, default=THETA,
+                        help='Barnes-Hut opening angle.')
+    parser.add_argument('-i', '--integrator', choices=sorted(INTEGRATORS), default='leapfrog',
+                        help='Time integrator of array engine.')
+    parser.add_argument('-r', '--compare-integrators', action='store_true',
+                        help='Report energy drift and force evaluations of integrators (predefined '
+                             'bodies or --count random bodies) and exit.')
+    parser.add_argument('-c', '--compare-forces', action='store_true',
+                        help='Report accuracy and speed of Barnes-Hut against direct sum '
+                             '(for --count random bodies) and exit.')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed for report.')
+    return parser.parse_args()
+
+
 def esetup():
     """ Hard-coded console for debug prints (std err).
     Console must exist before running script. """
@@ -103,6 +371,16 @@ def setup_curses():
     curses.curs_set(False)
 
 
+def setup_fade_colors():
+    """Color pair for every fade level. Return False if terminal has not enough colors."""
+    if curses.COLORS < 256 or curses.COLOR_PAIRS <= len(FADE_COLORS):
+        return False
+
+    for num, color in enumerate(FADE_COLORS):
+        curses.init_pair(num + 1, color, -1)
+    return True
+
+
 def check_exit_key(scr, step):
     """ Wait for key (defined by halfdelay), and check if q """
     # getch() is very slow, so check every 200 steps only
@@ -134,11 +412,14 @@ def predefined_bodies2():
     return bodies
 
 
-def rand_bodies():
+def rand_bodies(count=5, size=None):
+    width, height = size or (curses.COLS, curses.LINES)
     bodies = []
-    for i in range(5):
-        pos = Vector(random.randint(0, curses.COLS), random.randint(0, curses.LINES))
-        mass = random.randint(1, 1000)
+    # Total mass of light bodies stays the same as for five bodies
+    mass_scale = 5 / count
+    for i in range(count):
+        pos = Vector(random.randint(0, width), random.randint(0, height))
+        mass = random.randint(1, 1000) * mass_scale
         velocity = Vector(random.randint(-25, 25), random.randint(-25, 25))
         bodies.append(Body(pos, mass, velocity))
 
@@ -147,50 +428,60 @@ def rand_bodies():
     return bodies
 
 
-def clear_buf():
-    return [list(BLANK_BRAILLE * (curses.COLS - 1)) for _ in range(curses.LINES)]
-
-
-def draw_info(screen_buf, s):
-    screen_buf[0] = list(s) + screen_buf[0][len(s):]
+def clear_codes():
+    """Braille codes (dots bits) of screen cells."""
+    return np.zeros(shape=(curses.LINES, curses.COLS - 1), dtype=np.uint8)
 
 
-def draw_pt(screen_buf, pt):
-    x = int(pt.x / 2)
-    y = curses.LINES - 1 - int(pt.y / 4)
+def plot_points(codes, points):
+    """
+    Set braille dots of (N, 2) array of points (x, y) in codes array. Points
+    in the same cell are merged by np.bitwise_or.at.
+    """
+    dots = point_dots(points, codes.shape)
+    dots = dots[dots >= 0]
+    np.bitwise_or.at(codes.reshape(-1), dots // 8, (1 << (dots % 8)).astype(np.uint8))
 
-    if pt.y < 0 or y < 0 or pt.x < 0 or x >= curses.COLS - 1:
-        return
 
-    uchar = ord(screen_buf[y][x])
-    screen_buf[y][x] = unicode_char(uchar | relative_uchar(pt))
+def point_dots(points, shape):
+    """
+    Flat index of braille dot (cell index * 8 + dot bit number) of every
+    point, -1 for points outside of screen.
+    """
+    rows, cols = shape
+    pos = np.floor(points).astype(int)
+    x = pos[:, 0] // 2
+    y = rows - 1 - pos[:, 1] // 4
 
+    inside = np.all(pos >= 0, axis=1) & (y >= 0) & (x < cols)
+    dots = (y * cols + x) * 8 + BRAILLE_BITS[pos[:, 0] % 2, pos[:, 1] % 4]
+    return np.where(inside, dots, -1)
 
-def unicode_char(param):
-    if sys.version_info[0] == 2:
-        return unichr(param)
-    return chr(param)
 
+def braille_lines(codes):
+    """Screen lines from codes array, all braille chars converted at once."""
+    # Numpy unicode strings are UTF-32, so array of code points can be viewed as strings
+    chars = ord(BLANK_BRAILLE) | codes.astype(np.uint32)
+    return chars.view('U%d' % codes.shape[1])[:, 0].tolist()
 
-def relative_uchar(pt):
-    bx = int(pt.x) % 2
-    by = int(pt.y) % 4
 
-    if bx == 0:
-        if by == 0:
-            return 0x40
-        else:
-            return 0x4 >> (by - 1)
-    else:
-        if by == 0:
-            return 0x80
-        else:
-            return 0x20 >> (by -1)
+def draw_info(screen_buf, s):
+    screen_buf[0] = s + screen_buf[0][len(s):]
 
 
 def show(scr, screen_buf):
     for num, line in enumerate(screen_buf):
-        scr.addstr(num, 0, u''.join(line).encode('utf-8'))
+        scr.addstr(num, 0, line.encode('utf-8'))
+
+    scr.refresh()
+
+
+def show_faded(scr, screen_buf, levels):
+    """Same as show, but runs of cells with the same fade level get its color."""
+    for num, (line, line_levels) in enumerate(zip(screen_buf, levels)):
+        bounds = [0] + (np.flatnonzero(np.diff(line_levels)) + 1).tolist() + [len(line)]
+        for begin, end in zip(bounds, bounds[1:]):
+            scr.addstr(num, begin, line[begin:end].encode('utf-8'), curses.color_pair(line_levels[begin] + 1))
 
     scr.refresh()
 
@@ -211,14 +502,13 @@ def calcs(bodies, dt):
 
 def calc_forces(body1, body2, dt):
     dist = distance(body1.pos, body2.pos)
-    if dist < 1:
-        exit()
 
-    dir1 = (body2.pos - body1.pos).normalize()
-    dir2 = (body1.pos - body2.pos).normalize()
-    grav_mag = (GRAVITY * body1.mass * body2.mass) / (dist**2)
-    force1 = dir1 * grav_mag
-    force2 = dir2 * grav_mag
+    # Softened gravity: (dist / (dist**2 + SOFTENING**2)**1.5) instead of
+    # 1/dist**2, so close bodies don't blow up (and direction of bodies in
+    # the same point isn't needed)
+    grav_mag = (GRAVITY * body1.mass * body2.mass) / (dist**2 + SOFTENING**2)**1.5
+    force1 = (body2.pos - body1.pos) * grav_mag
+    force2 = (body1.pos - body2.pos) * grav_mag
 
     return force1, force2
 
@@ -227,6 +517,225 @@ def distance(vec1, vec2):
     return math.sqrt((vec1.x - vec2.x)**2 + (vec1.y - vec2.y)**2)
 
 
+def calcs_array(cluster, dt, force=None):
+    """
+    Same as calcs for Cluster (semi-implicit Euler). Force is function
+    computing accelerations.
+    """
+    force = force or accelerations
+    acc = force(cluster.pos, cluster.mass)
+    cluster.force_evals += 1
+    cluster.vel += acc * dt
+    cluster.pos += cluster.vel * dt
+
+
+def leapfrog(cluster, dt, force=None):
+    """
+    Leapfrog in kick-drift-kick form (velocity Verlet). Symplectic, so energy
+    error stays bounded instead of drifting. Acceleration of the end of step
+    is reused at the beginning of next one, so one force evaluation per step.
+    """
+    force = force or accelerations
+    if cluster.acc is None:
+        cluster.acc = force(cluster.pos, cluster.mass)
+        cluster.force_evals += 1
+
+    cluster.vel += cluster.acc * (dt / 2)
+    cluster.pos += cluster.vel * dt
+    cluster.acc = force(cluster.pos, cluster.mass)
+    cluster.force_evals += 1
+    cluster.vel += cluster.acc * (dt / 2)
+
+
+# Dormand-Prince 5(4) coefficients
+RK_A = [
+    [],
+    [1/5],
+    [3/40, 9/40],
+    [44/45, -56/15, 32/9],
+    [19372/6561, -25360/2187, 64448/6561, -212/729],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84],
+]
+RK_ERROR = np.array([35/384 - 5179/57600, 0, 500/1113 - 7571/16695, 125/192 - 393/640,
+                     -2187/6784 + 92097/339200, 11/84 - 187/2100, -1/40])
+
+
+def rk45(cluster, dt, force=None):
+    """
+    Adaptive Dormand-Prince RK45. Frame interval dt is covered by steps of
+    size chosen from error estimate (difference of 5th and 4th order
+    solutions), step size is kept between frames. Last stage of accepted step
+    is first stage of next one (also between frames, as cluster.acc), so six
+    force evaluations per step.
+    """
+    force = force or accelerations
+
+    def derivative(state):
+        cluster.force_evals += 1
+        return np.stack([state[1], force(state[0], cluster.mass)])
+
+    state = np.stack([cluster.pos, cluster.vel])
+    step_size = min(cluster.step_size or dt, dt)
+    if cluster.acc is None:
+        first = derivative(state)
+    else:
+        first = np.stack([state[1], cluster.acc])
+    time_left = dt
+
+    while time_left > 0:
+        h = min(step_size, time_left)
+        stages = [first]
+        for coeffs in RK_A[1:]:
+            stages.append(derivative(state + h * sum(c * k for c, k in zip(coeffs, stages))))
+        new_state = state + h * sum(c * k for c, k in zip(RK_A[-1], stages))
+
+        error = h * sum(c * k for c, k in zip(RK_ERROR, stages))
+        scale = RK_ATOL + RK_RTOL * np.maximum(np.abs(state), np.abs(new_state))
+        error_norm = np.max(np.abs(error) / scale, initial=0)
+
+        if error_norm <= 1:
+            state = new_state
+            first = stages[-1]
+            time_left -= h
+        step_size = h * min(5, max(0.2, 0.9 * error_norm**-0.2 if error_norm else 5))
+
+    cluster.step_size = step_size
+    cluster.acc = first[1]
+    cluster.pos[:] = state[0]
+    cluster.vel[:] = state[1]
+
+
+def total_energy(cluster):
+    """Kinetic and (softened) potential energy of cluster."""
+    kinetic = 0.5 * np.sum(cluster.mass * np.sum(cluster.vel**2, axis=1))
+
+    potential = 0
+    pos = cluster.pos
+    rows = max(1, CHUNK_PAIRS // max(len(pos), 1))
+    for begin in range(0, len(pos), rows):
+        chunk = pos[begin:begin + rows]
+        dist_squared = (pos[:, 0] - chunk[:, 0, np.newaxis])**2 + (pos[:, 1] - chunk[:, 1, np.newaxis])**2
+        potential -= np.sum(cluster.mass[begin:begin + rows, np.newaxis] * cluster.mass /
+                            np.sqrt(dist_squared + SOFTENING**2))
+    # Every pair was counted twice, body with itself once
+    potential = GRAVITY * (potential + np.sum(cluster.mass**2) / SOFTENING) / 2
+
+    return kinetic + potential
+
+
+def energy_drift(energy0, energy):
+    """Relative change of total energy."""
+    return abs((energy - energy0) / energy0)
+
+
+def accelerations(pos, mass):
+    """
+    Gravitational acceleration of every body, from all pairs by broadcasting.
+    Bodies are processed in chunks of rows, so (rows, N) temporary arrays
+    have at most CHUNK_PAIRS pairs. Gravity is softened (see calc_forces),
+    body with itself gives zero.
+    """
+    acc = np.zeros_like(pos)
+    rows = max(1, CHUNK_PAIRS // max(len(pos), 1))
+    x, y = pos[:, 0], pos[:, 1]
+
+    for begin in range(0, len(pos), rows):
+        chunk = pos[begin:begin + rows]
+        dist_squared = (x - chunk[:, 0, np.newaxis])**2 + (y - chunk[:, 1, np.newaxis])**2
+        # Sum of m_j * (p_j - p_i) / d^3 is W @ p - sum(W) * p_i, for W = m_j / d^3
+        weights = mass / (dist_squared + SOFTENING**2)**1.5
+        acc[begin:begin + rows] = GRAVITY * (weights @ pos - weights.sum(axis=1)[:, np.newaxis] * chunk)
+
+    return acc
+
+
+def barnes_hut(pos, mass, theta=THETA):
+    """Accelerations approximated by Barnes-Hut quadtree."""
+    return QuadTree(pos, mass).accelerations(pos, theta)
+
+
+def spread_bits(values):
+    """Spread 16 bits of values to even bits (for Morton code)."""
+    values = values.astype(np.uint64)
+    for shift, mask in ((8, 0x00FF00FF), (4, 0x0F0F0F0F), (2, 0x33333333), (1, 0x55555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def compare_forces(count, thetas, seed):
+    """
+    Accuracy vs speed of Barnes-Hut against direct sum, for random bodies.
+    Error is relative error of acceleration of body.
+    """
+    random.seed(seed)
+    cluster = Cluster(rand_bodies(count, size=(REPORT_WIDTH, REPORT_HEIGHT)))
+
+    tic = time.perf_counter()
+    direct = accelerations(cluster.pos, cluster.mass)
+    direct_time = time.perf_counter() - tic
+    direct_mag = np.maximum(np.sqrt(np.sum(direct**2, axis=1)), np.finfo(float).tiny)
+
+    print('Bodies: %d, direct sum: %.4f sec' % (count, direct_time))
+    print('%6s %10s %8s %13s %10s %10s %10s' % ('theta', 'time [s]', 'speedup', 'interactions', 'mean err',
+                                               'p99 err', 'max err'))
+    for theta in thetas:
+        tic = time.perf_counter()
+        tree = QuadTree(cluster.pos, cluster.mass)
+        approx = tree.accelerations(cluster.pos, theta)
+        elapsed = time.perf_counter() - tic
+
+        err = np.sqrt(np.sum((approx - direct)**2, axis=1)) / direct_mag
+        print('%6.2f %10.4f %7.1fx %13.1f %10.2e %10.2e %10.2e' % (theta, elapsed, direct_time / elapsed,
+              tree.interactions / max(count, 1), err.mean(), np.percentile(err, 99), err.max()))
+
+
+def compare_integrators(count, seed):
+    """
+    Energy drift and cost of integrators for the same simulated time, for
+    several frame intervals.
+    """
+    random.seed(seed)
+    bodies = rand_bodies(count, size=(REPORT_WIDTH, REPORT_HEIGHT)) if count else predefined_bodies2()
+
+    print('Bodies: %d, simulated time: %.1f' % (len(bodies), REPORT_TIME))
+    print('%-10s %7s %12s %10s %12s %12s' % ('integrator', 'dt', 'force evals', 'time [s]', 'final dE',
+                                              'max dE'))
+    for name in sorted(INTEGRATORS):
+        for dt in REPORT_DTS:
+            cluster = Cluster(bodies)
+            energy0 = total_energy(cluster)
+            max_drift = 0
+
+            tic = time.perf_counter()
+            for _ in range(round(REPORT_TIME / dt)):
+                INTEGRATORS[name](cluster, dt)
+                max_drift = max(max_drift, energy_drift(energy0, total_energy(cluster)))
+            elapsed = time.perf_counter() - tic
+
+            print('%-10s %7.3f %12d %10.4f %12.2e %12.2e' % (name, dt, cluster.force_evals, elapsed,
+                  energy_drift(energy0, total_energy(cluster)), max_drift))
+
+
+FORCES = {
+    'direct': accelerations,
+    'barnes-hut': barnes_hut,
+}
+
+
+INTEGRATORS = {
+    'euler': calcs_array,
+    'leapfrog': leapfrog,
+    'rk45': rk45,
+}
+
+
 if __name__ == '__main__':
-    locale.setlocale(locale.LC_ALL, '')
-    curses.wrapper(main)
+    args = parse_args()
+    if args.compare_forces:
+        compare_forces(args.count or 10000, REPORT_THETAS, args.seed)
+    elif args.compare_integrators:
+        compare_integrators(args.count, args.seed)
+    else:
+        locale.setlocale(locale.LC_ALL, '')
+        curses.wrapper(main, args)
@@ -12,12 +12,16 @@ import time
 import curses
 import locale
 import typing as t
+import numpy as np
 
 
 BLANK_BRAILLE = 0x2800
 BLANK_VALUE = 0x00
 CELL_WIDTH = 2
 CELL_HEIGHT = 4
+# Braille dot bits indexed by [x % 2, y % 4] (y grows up, so y % 4 == 0 is
+# bottom row of cell)
+BRAILLE_DOTS = np.array([[0x40, 0x04, 0x02, 0x01], [0x80, 0x20, 0x10, 0x08]], dtype=np.uint8)
 
 Point = co.namedtuple("Point", ["x", "y"])
 
@@ -84,24 +88,25 @@ def rotate_points(angle: float, center_pt: Point, points: t.List) -> t.List:
 
 
 def draw_figure(
-    points: t.List, code_buffer: t.List, screen_buffer: t.List, draw_code: t.Callable
+    points: t.List,
+    code_buffer: np.ndarray,
+    screen_buffer: np.ndarray,
+    draw_code: t.Callable,
 ) -> None:
-    """Draw lines between points."""
+    """Draw lines between points. All points of figure are plotted at once."""
+    line_points = []
     for start, end in zip(points, points[1:] + [points[0]]):
         start = Point(int(start.x), int(start.y))
         end = Point(int(end.x), int(end.y))
-        draw_line(start, end, code_buffer, screen_buffer, draw_code)
+        draw_line(start, end, line_points)
 
+    rows, cols = plot_points(code_buffer, np.array(line_points))
+    screen_buffer[rows, cols] = draw_code(code_buffer[rows, cols])
 
-def draw_line(
-    pt1: Point,
-    pt2: Point,
-    code_buffer: t.List,
-    screen_buffer: t.List,
-    draw_code: t.Callable,
-) -> None:
+
+def draw_line(pt1: Point, pt2: Point, line_points: t.List) -> None:
     """
-    Draw line - Bresenham's line algorithm
+    Collect line points - Bresenham's line algorithm
     - https://pl.wikipedia.org/wiki/Algorytm_Bresenhama
     """
     x, y = pt1.x, pt1.y
@@ -121,8 +126,7 @@ def draw_line(
         yi = -1
         dy = pt1.y - pt2.y
 
-    set_point(Point(x, y), code_buffer)
-    draw_code(Point(x, y), code_buffer, screen_buffer)
+    line_points.append((x, y))
 
     # X axis
     if dx > dy:
@@ -138,8 +142,7 @@ def draw_line(
             else:
                 d += bi
                 x += xi
-            set_point(Point(x, y), code_buffer)
-            draw_code(Point(x, y), code_buffer, screen_buffer)
+            line_points.append((x, y))
     # Y axis
     else:
         ai = (dx - dy) * 2
@@ -154,50 +157,39 @@ def draw_line(
             else:
                 d += bi
                 y += yi
-            set_point(Point(x, y), code_buffer)
-            draw_code(Point(x, y), code_buffer, screen_buffer)
-
-
-def set_point(pt: Point, code_buffer: t.List) -> None:
-    """Set code as bit (unicode braille dot numbering) in cell."""
-    row = curses.LINES - 1 - int(pt.y / CELL_HEIGHT)
-    if row < 0:
-        return
-
-    col = int(pt.x / CELL_WIDTH)
-    code_buffer[row][col] |= point_to_code(pt.y, pt.x)
-
-
-def point_to_code(y: int, x: int) -> int:
-    """Calculate braille dot number from point position."""
-    bx = x % CELL_WIDTH
-    by = y % CELL_HEIGHT
+            line_points.append((x, y))
 
-    if bx == 0:
-        if by == 0:
-            return 0x40
-        else:
-            return 0x4 >> (by - 1)
-    else:
-        if by == 0:
-            return 0x80
-        else:
-            return 0x20 >> (by - 1)
 
+def plot_points(code_buffer: np.ndarray, points: np.ndarray) -> t.Tuple:
+    """
+    Set braille dots (unicode braille dot numbering) of (N, 2) array of
+    points (x, y) in code buffer. Points in the same cell are merged by
+    np.bitwise_or.at. Return rows and columns of cells with points.
+    """
+    rows, cols = code_buffer.shape
+    points = points.reshape(-1, 2)
+    points = points[np.all(points >= 0, axis=1)]
+    pos = points.astype(int)
+    x = pos[:, 0] // CELL_WIDTH
+    y = rows - 1 - pos[:, 1] // CELL_HEIGHT
+
+    inside = (y >= 0) & (x < cols)
+    pos, y, x = pos[inside], y[inside], x[inside]
+    np.bitwise_or.at(
+        code_buffer, (y, x), BRAILLE_DOTS[pos[:, 0] % CELL_WIDTH, pos[:, 1] % CELL_HEIGHT]
+    )
+    return y, x
 
-def code_to_braille(pt: Point, code_buffer: t.List, screen_buffer: t.List) -> None:
-    """Translate cell code (braille dot number) to proper Braille code."""
-    row = curses.LINES - 1 - int(pt.y / CELL_HEIGHT)
-    if row < 0:
-        return
 
-    col = int(pt.x / CELL_WIDTH)
-    screen_buffer[row][col] = chr(BLANK_BRAILLE | code_buffer[row][col])
+def code_to_braille(codes: np.ndarray) -> np.ndarray:
+    """Translate cell codes (braille dot numbers) to proper Braille chars."""
+    # Numpy unicode strings are UTF-32, so code points can be viewed as chars
+    return (BLANK_BRAILLE | codes.astype(np.uint32)).view("U1")
 
 
-def code_to_ascii(pt: Point, code_buffer: t.List, screen_buffer: t.List) -> None:
+def code_to_ascii(codes: np.ndarray) -> np.ndarray:
     """
-    Translate cell code (braille dot number) to ASCII character.
+    Translate cell codes (braille dot numbers) to ASCII characters.
 
     Extracted from:
     https://github.com/MateuszJanda/textmode-playground/tools/braille_to_ascii.csv
@@ -209,19 +201,12 @@ def code_to_ascii(pt: Point, code_buffer: t.List, screen_buffer: t.List) -> None
         "_--.LL.L,-8.__:\\-ZFF=sFl``,e6__s',,\\=P\"L','.E5*5',,t,cct'7.F'',E"
     )
 
-    row = curses.LINES - 1 - int(pt.y / CELL_HEIGHT)
-    if row < 0:
-        return
-
-    col = int(pt.x / CELL_WIDTH)
-    screen_buffer[row][col] = code_replacement[code_buffer[row][col]]
+    return np.array(list(code_replacement))[codes]
 
 
-def code_to_unicode_subset(
-    pt: Point, code_buffer: t.List, screen_buffer: t.List
-) -> None:
+def code_to_unicode_subset(codes: np.ndarray) -> np.ndarray:
     """
-    Translate cell code (braille dot number) to Unicode character.
+    Translate cell codes (braille dot numbers) to Unicode characters.
 
     Extracted from:
     https://github.com/MateuszJanda/textmode-playground/tools/braille_to_unicode_subset.csv
@@ -233,39 +218,28 @@ def code_to_unicode_subset(
         "‥╴‐Ĺь└ʟ⁽᾿⁚′·–╺∍קּ∴‑⁚‼Ⅎв϶‼᾽ˑ῀‼┚‒‼‼’ʻₕ⊦=ьͱı‘ʹℐ.Ⅎ‒ɔℐʹʻ‚ʾ⁖΄ₒʰ͵,.ʼ⁖ʼₚₒ"
     )
 
-    row = curses.LINES - 1 - int(pt.y / CELL_HEIGHT)
-    if row < 0:
-        return
-
-    col = int(pt.x / CELL_WIDTH)
-    screen_buffer[row][col] = code_replacement[code_buffer[row][col]]
+    return np.array(list(code_replacement))[codes]
 
 
-def empty_code_buffer() -> t.List:
+def empty_code_buffer() -> np.ndarray:
     """Create empty code buffer."""
-    code_buffer = []
-    for _ in range(curses.LINES):
-        code_buffer.append([BLANK_VALUE] * (curses.COLS - 1))
+    return np.full((curses.LINES, curses.COLS - 1), BLANK_VALUE, dtype=np.uint8)
 
-    return code_buffer
 
-
-def empty_screen_buffer() -> t.List:
+def empty_screen_buffer() -> np.ndarray:
     """Create empty screen buffer."""
-    screen_buffer = []
-    for _ in range(curses.LINES):
-        screen_buffer.append([" "] * (curses.COLS - 1))
-
-    return screen_buffer
+    return np.full((curses.LINES, curses.COLS - 1), " ", dtype="U1")
 
 
-def refresh_screen(scr: t.Any, screen_buffer: t.List) -> None:
+def refresh_screen(scr: t.Any, screen_buffer: np.ndarray) -> None:
     """Clear screen and print screen buffer content."""
     # https://stackoverflow.com/questions/24964940/python-curses-tty-screen-blink
     scr.erase()
 
-    for num, line in enumerate(screen_buffer):
-        scr.addstr(num, 0, "".join(line).encode("utf-8"))
+    # Whole rows of chars viewed as strings
+    lines = screen_buffer.view("U%d" % screen_buffer.shape[1])[:, 0]
+    for num, line in enumerate(lines):
+        scr.addstr(num, 0, line.encode("utf-8"))
 
     scr.refresh()
 
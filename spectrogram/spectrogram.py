@@ -6,8 +6,10 @@
 
 import sys
 import os
-import itertools as it
+import tty
+import termios
 import ctypes as ct
+import collections as co
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from scipy import signal
@@ -42,6 +44,7 @@ def main():
     # plt.show()
 
     screen = Screen()
+    # screen = AnsiScreen()
     screen.render(samples, sample_rate)
     screen.endwin()
 
@@ -93,6 +96,15 @@ def log10(spectrogram):
     return np.log10(spectrogram)
 
 
+def encode_blocks(spectrogram):
+    """
+    Pair numbers of LOWER_HALF_BLOCK cells for whole spectrogram (two rows per
+    cell). Upper row is background, lower is foreground.
+    """
+    colors = np.clip(spectrogram, 0, cm.inferno.N - 1).astype(int)
+    return colors[0::2] * cm.inferno.N + colors[1::2]
+
+
 class Screen:
     A_NORMAL = 0
     # https://en.wikipedia.org/wiki/List_of_Unicode_characters#Block_Elements
@@ -127,27 +139,17 @@ class Screen:
 
         assert cm.inferno.N == 256
 
-        for bg, fg in it.product(range(cm.inferno.N), range(cm.inferno.N)):
-            pair_num = bg * cm.inferno.N + fg
-
-            if pair_num == 0:
-                continue
-
-            ret = self._ncurses.init_extended_pair(pair_num, fg, bg)
-            if ret != 0:
-                show('init_extended_pair error: %d, for pair_num: %d' % (ret, pair_num))
-                raise RuntimeError
+        # Pairs are registered on first use
+        self._pairs = ColorPairs(self._ncurses)
 
     def render(self, samples, sample_rate):
         """Draw buffer content on screen."""
         spectrogram = self._spectogram(samples, sample_rate)
+        pairs = encode_blocks(spectrogram)
 
-        for shift in range(spectrogram.shape[1] - self.COLS):
-            for y, x in it.product(range(self.LINES), range(self.COLS)):
-                bg, fg = spectrogram[y*2:y*2+2, x+shift]
-                pair_num = int(bg) * cm.inferno.N + int(fg)
-
-                self.print(y, x, pair_num, Screen.LOWER_HALF_BLOCK)
+        for shift in range(pairs.shape[1] - self.COLS):
+            for (y, x), pair_num in np.ndenumerate(pairs[:self.LINES, shift:shift+self.COLS]):
+                self.print(y, x, int(pair_num), Screen.LOWER_HALF_BLOCK)
 
             self.refresh()
 
@@ -176,6 +178,9 @@ class Screen:
         return spectrogram
 
     def print(self, y, x, pair_num, text):
+        bg, fg = divmod(pair_num, cm.inferno.N)
+        pair_num = self._pairs.get(fg, bg)
+
         pair_num_short = ct.cast((ct.c_int*1)(pair_num), ct.POINTER(ct.c_short)).contents
         pair_num_pt = ct.c_int(pair_num)
         ret = self._ncurses.attr_set(ct.c_int(self.A_NORMAL), pair_num_short, ct.pointer(pair_num_pt))
@@ -200,5 +205,109 @@ class Screen:
         show('The end.')
 
 
+class AnsiScreen(Screen):
+    """
+    Screen without ncurses. Cells get exact 24-bit ("true color") colors from
+    colormap, there is no color pairs limit. Frame is kept in buffer and on
+    refresh all changed lines are written with single os.write, color codes
+    are emitted only when colors change.
+    """
+    ESC = '\x1b['
+
+    def __init__(self):
+        rgb = (np.array(cm.inferno.colors)[:, :3] * 255).round().astype(int)
+        self._fg_codes = [self.ESC + '38;2;%d;%d;%dm' % tuple(c) for c in rgb]
+        self._bg_codes = [self.ESC + '48;2;%d;%d;%dm' % tuple(c) for c in rgb]
+
+        size = os.get_terminal_size()
+        self.LINES, self.COLS = size.lines, size.columns - 1
+        self._chars = [[' '] * self.COLS for _ in range(self.LINES)]
+        self._colors = [[(0, 0)] * self.COLS for _ in range(self.LINES)]
+        self._dirty_lines = set()
+
+        self._fd = sys.stdout.fileno()
+        self._tty_attr = termios.tcgetattr(self._fd)
+        tty.setcbreak(self._fd)
+
+        # Alternate screen buffer, hide cursor
+        self._write(self.ESC + '?1049h' + self.ESC + '?25l')
+
+    def print(self, y, x, pair_num, text):
+        bg, fg = divmod(pair_num, cm.inferno.N)
+
+        end = min(x + len(text), self.COLS)
+        self._chars[y][x:end] = text[:end - x]
+        self._colors[y][x:end] = [(fg, bg)] * (end - x)
+        self._dirty_lines.add(y)
+
+    def refresh(self):
+        buf = []
+        for y in sorted(self._dirty_lines):
+            buf.append(self.ESC + '%d;1H' % (y + 1))
+
+            fg, bg = None, None
+            for char, (cell_fg, cell_bg) in zip(self._chars[y], self._colors[y]):
+                if cell_fg != fg:
+                    fg = cell_fg
+                    buf.append(self._fg_codes[fg])
+                if cell_bg != bg:
+                    bg = cell_bg
+                    buf.append(self._bg_codes[bg])
+                buf.append(char)
+
+        self._dirty_lines.clear()
+        self._write(''.join(buf))
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+
+    def endwin(self):
+        while sys.stdin.read(1) != 'q':
+            pass
+
+        self._write(self.ESC + '0m' + self.ESC + '?25h' + self.ESC + '?1049l')
+        termios.tcsetattr(self._fd, termios.TCSADRAIN, self._tty_attr)
+
+        show('The end.')
+
+
+class ColorPairs:
+    """
+    Color pairs registered in ncurses on first use. There are only COLOR_PAIRS
+    pairs available, so when limit is reached least recently used pair is
+    redefined.
+    """
+
+    def __init__(self, ncurses):
+        self._ncurses = ncurses
+        # Pair number 0 is reserved by lib, and can't be initialized
+        self.limit = ct.c_int.in_dll(ncurses, 'COLOR_PAIRS').value - 1
+        self._pairs = co.OrderedDict()  # (fg, bg) -> pair_num
+
+    def get(self, fg, bg):
+        """Pair number for two colors."""
+        key = (fg, bg)
+        pair_num = self._pairs.get(key)
+        if pair_num is not None:
+            self._pairs.move_to_end(key)
+            return pair_num
+
+        if len(self._pairs) < self.limit:
+            pair_num = len(self._pairs) + 1
+        else:
+            _, pair_num = self._pairs.popitem(last=False)
+
+        ret = self._ncurses.init_extended_pair(pair_num, fg, bg)
+        if ret != 0:
+            show('init_extended_pair error: %d, for pair_num: %d' % (ret, pair_num))
+            raise RuntimeError
+
+        self._pairs[key] = pair_num
+        return pair_num
+
+
 if __name__ == '__main__':
     main()